@@ -1,17 +1,138 @@
 # app.py
-from fastapi import FastAPI, Form
+from fastapi import FastAPI, Form, HTTPException
 from fastapi.responses import HTMLResponse
+from pydantic import BaseModel
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
 import html
-import tempfile
+import os
+import threading
 
-from main import generate_song_artifacts
+from cache import ArtifactCache, artifact_key
+from jobs import JobPool, JobTimeout, PoolBusy
+from main import analyse_song, render_song_artifacts
+from notemapper import check_analysis_rate
 
 app = FastAPI()
 
-def run_script(input_str: str, song_num: int) -> str:
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as tmp:
-        output_path = tmp.name
-    return generate_song_artifacts(input_str, output_path, song_num)
+cache = ArtifactCache(
+    max_entries=int(os.environ.get("CACHE_MAX_ENTRIES", "256")),
+    max_bytes=int(os.environ.get("CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+    disk_dir=os.environ.get("CACHE_DIR") or None,
+)
+
+WORKERS = int(os.environ.get("WORKERS", str(os.cpu_count() or 1)))
+QUEUE_DEPTH = int(os.environ.get("QUEUE_DEPTH", str(2 * WORKERS)))
+JOB_TIMEOUT = float(os.environ.get("JOB_TIMEOUT", "30"))
+RETRY_AFTER = int(os.environ.get("RETRY_AFTER", "5"))
+# Batches wait for workers instead of failing, so they are capped in size and
+# in how many of their jobs may hold a worker or queue slot at once; the rest
+# of the pool stays free for the form
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "32"))
+BATCH_MAX_JOBS = int(os.environ.get("BATCH_MAX_JOBS", str(max(1, WORKERS // 2))))
+# Sample rate the audio modes analyse at; unset analyses at the synth rate.
+# A rate too low to analyse at fails here rather than on every request.
+ANALYSIS_SAMPLE_RATE = int(os.environ.get("ANALYSIS_SAMPLE_RATE", "0")) or None
+if ANALYSIS_SAMPLE_RATE is not None:
+    check_analysis_rate(ANALYSIS_SAMPLE_RATE)
+
+# Worker processes are only spawned once the first job needs them
+_pool = None
+_pool_lock = threading.Lock()
+_batch_slots = threading.BoundedSemaphore(BATCH_MAX_JOBS)
+
+def get_pool() -> JobPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = JobPool(WORKERS, QUEUE_DEPTH, JOB_TIMEOUT)
+        return _pool
+
+@app.on_event("shutdown")
+def close_pool():
+    # Forget the closed pool so a later startup in this process gets a new one
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+def get_analysis(input_str: str, mode: str = "audio", wait: bool = False) -> dict:
+    key = artifact_key(input_str, mode, ANALYSIS_SAMPLE_RATE)
+    analysis = cache.get(key)
+    if analysis is None:
+        pool = get_pool()
+        if wait:
+            with _batch_slots:
+                analysis = pool.run_when_free(analyse_song, input_str, mode=mode,
+                                              analysis_rate=ANALYSIS_SAMPLE_RATE)
+        else:
+            analysis = pool.run(analyse_song, input_str, mode=mode,
+                                analysis_rate=ANALYSIS_SAMPLE_RATE)
+        cache.put(key, analysis)
+    return analysis
+
+def run_script(input_str: str, song_num: int, mode: str = "audio") -> str:
+    return render_song_artifacts(get_analysis(input_str, mode), song_num)
+
+def error_page(status_code: int, message: str, headers: dict = None) -> HTMLResponse:
+    body = f"<html><body><h1>{status_code}</h1><p>{html.escape(message)}</p><a href=\"/\">Back</a></body></html>"
+    return HTMLResponse(body, status_code=status_code, headers=headers)
+
+@app.get("/cache/stats")
+def cache_stats():
+    return cache.stats()
+
+class BatchItem(BaseModel):
+    rtttl: str
+    song_num: int
+    mode: str = "audio"
+
+class BatchRequest(BaseModel):
+    songs: List[BatchItem]
+
+def _batch_item(item: BatchItem) -> dict:
+    try:
+        # Batch items wait for a pool slot rather than failing with 503
+        analysis = get_analysis(item.rtttl, item.mode, wait=True)
+    except Exception as e:
+        return {"song_num": item.song_num, "ok": False, "error": str(e) or type(e).__name__}
+
+    return {
+        "song_num": item.song_num,
+        "ok": True,
+        "arrays": dict(analysis, num_notes=len(analysis["lanes"])),
+        "code": render_song_artifacts(analysis, item.song_num),
+    }
+
+@app.post("/api/batch")
+def batch(request: BatchRequest):
+    if len(request.songs) > BATCH_MAX_ITEMS:
+        raise HTTPException(413, f"batch of {len(request.songs)} songs exceeds the limit of "
+                                 f"{BATCH_MAX_ITEMS}")
+
+    seen = set()
+    duplicates = set()
+    for item in request.songs:
+        if item.song_num in seen:
+            duplicates.add(item.song_num)
+        seen.add(item.song_num)
+
+    todo = [item for item in request.songs if item.song_num not in duplicates]
+    with ThreadPoolExecutor(max_workers=max(1, min(BATCH_MAX_JOBS, len(todo)))) as executor:
+        done = dict(zip((id(item) for item in todo), executor.map(_batch_item, todo)))
+
+    results = []
+    for item in request.songs:
+        if item.song_num in duplicates:
+            results.append({"song_num": item.song_num, "ok": False,
+                            "error": f"duplicate song_num {item.song_num} in batch"})
+        else:
+            results.append(done[id(item)])
+
+    code = [r.pop("code") for r in results if r["ok"]]
+    header = "#pragma once\n\n" + "\n\n".join(code) + "\n"
+    return {"songs": results, "header": header}
 
 @app.get("/", response_class=HTMLResponse)
 def form():
@@ -80,7 +201,8 @@ def form():
           }
 
           textarea,
-          input[type="number"] {
+          input[type="number"],
+          select {
             width: 100%;
             border: 1px solid rgba(0, 0, 0, 0.12);
             border-radius: 12px;
@@ -99,7 +221,8 @@ def form():
           }
 
           textarea:focus,
-          input[type="number"]:focus {
+          input[type="number"]:focus,
+          select:focus {
             outline: none;
             border-color: var(--accent);
             box-shadow: 0 0 0 4px var(--ring);
@@ -162,6 +285,14 @@ def form():
                 <label>Song Number</label>
                 <input type="number" name="song_num" value="2" min="0"/>
               </div>
+              <div>
+                <label>Note Map</label>
+                <select name="mode">
+                  <option value="audio" selected>Audio analysis</option>
+                  <option value="score">Score (fast)</option>
+                  <option value="flux">Onset detection</option>
+                </select>
+              </div>
             </div>
             <div class="actions">
               <button type="submit">Generate</button>
@@ -173,8 +304,14 @@ def form():
     """
 
 @app.post("/", response_class=HTMLResponse)
-def run(rtttl_str: str = Form(...), song_num: int = Form(...)):
-    output = run_script(rtttl_str, song_num)
+def run(rtttl_str: str = Form(...), song_num: int = Form(...), mode: str = Form("audio")):
+    try:
+        output = run_script(rtttl_str, song_num, mode)
+    except PoolBusy:
+        return error_page(503, "Server busy, try again shortly.",
+                          headers={"Retry-After": str(RETRY_AFTER)})
+    except JobTimeout:
+        return error_page(504, "Generating this song took too long.")
     escaped = html.escape(output)
     return f"""
     <html>
@@ -0,0 +1,120 @@
+"""
+How closely charts mapped from audio at a reduced analysis rate agree with
+charts mapped at the full synth rate.
+
+    python -m benchmarks.analysis_rate [--rates 22050] [--songs 6]
+        [--tolerance-ms 50] [--min-agreement 0.9]
+
+Exact note times are a poor yardstick: one decision that flips under the
+cooldown and streak rules shifts every later note, and even 1e-5 of added
+noise moves a chart at the full rate. Agreement is therefore measured on
+what a player notices, the density and the lane mix: the note count ratio
+(smaller over larger) times one minus the total variation distance between
+the two charts' lane shares. The F1 score of notes matched in the same lane
+within the tolerance is shown alongside.
+
+Per-song agreement is noisy for short songs, so the check is on the corpus
+totals: exits with status 1 if the agreement of any engine's summed lane
+counts at any rate is below --min-agreement. Rates below
+notemapper.MIN_ANALYSIS_RATE would leave the treble lane empty and are
+rejected.
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+
+import notemapper
+from benchmarks.onset_accuracy import corpus
+from ptttl import audio
+from ptttl.parser import PTTTLParser
+
+
+def lane_counts(lanes):
+    return np.bincount(np.asarray(lanes, dtype=np.int64), minlength=len(notemapper.LANE_RANGES))
+
+
+def agreement(ref_counts, counts):
+    if not ref_counts.sum() or not counts.sum():
+        return float(ref_counts.sum() == counts.sum())
+
+    density = min(counts.sum(), ref_counts.sum()) / float(max(counts.sum(), ref_counts.sum()))
+    lane_mix = 1.0 - 0.5 * np.abs(counts / counts.sum() - ref_counts / ref_counts.sum()).sum()
+    return density * lane_mix
+
+
+def matched_f1(reference, other, tolerance_ms):
+    def hits(a, b):
+        total = 0
+        for lane in range(len(notemapper.LANE_RANGES)):
+            times_a = np.asarray([t for l, t in zip(*a) if l == lane], dtype=np.float64)
+            times_b = np.sort([t for l, t in zip(*b) if l == lane])
+            if not len(times_a) or not len(times_b):
+                continue
+            idx = np.searchsorted(times_b, times_a)
+            before = np.abs(times_a - times_b[np.maximum(idx - 1, 0)])
+            after = np.abs(times_a - times_b[np.minimum(idx, len(times_b) - 1)])
+            total += np.count_nonzero(np.minimum(before, after) <= tolerance_ms)
+        return total
+
+    if not len(reference[0]) or not len(other[0]):
+        return float(len(reference[0]) == len(other[0]))
+    recall = hits(reference, other) / float(len(reference[0]))
+    precision = hits(other, reference) / float(len(other[0]))
+    return 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rates', type=int, nargs='+', default=[22050])
+    parser.add_argument('--songs', type=int, default=6)
+    parser.add_argument('--tolerance-ms', type=float, default=50.0)
+    parser.add_argument('--min-agreement', type=float, default=0.9)
+    args = parser.parse_args()
+    for rate in args.rates:
+        try:
+            notemapper.check_analysis_rate(rate)
+        except ValueError as e:
+            parser.error(str(e))
+
+    print("%-10s %-6s %6s | %-16s %6s %6s %8s"
+          % ("song", "engine", "rate", "notes per lane", "agree", "F1", "ms"))
+
+    totals = {}
+    for name, source in corpus(args.songs):
+        data = PTTTLParser().parse(source)
+        for engine in ('peaks', 'flux'):
+            backend = notemapper.NOTE_MAP_BACKENDS[engine]
+            reference = None
+            for rate in [audio.SAMPLE_RATE] + args.rates:
+                samples = audio.ptttl_data_to_samples(data, sample_rate=rate)
+                start = time.perf_counter()
+                chart = backend(samples, rate, reference_rate=notemapper.REFERENCE_SAMPLE_RATE)[:2]
+                elapsed = time.perf_counter() - start
+
+                if reference is None:
+                    reference = chart
+                counts = lane_counts(chart[0])
+                ref_counts = lane_counts(reference[0])
+                if rate != audio.SAMPLE_RATE:
+                    total = totals.setdefault((engine, rate), [0, 0])
+                    total[0] += ref_counts
+                    total[1] += counts
+                print("%-10s %-6s %6d | %-16s %6.2f %6.2f %8.1f"
+                      % (name, engine, rate, '/'.join('%d' % c for c in counts),
+                         agreement(ref_counts, counts),
+                         matched_f1(reference, chart, args.tolerance_ms), elapsed * 1000))
+
+    print()
+    worst = 1.0
+    for (engine, rate), (ref_counts, counts) in sorted(totals.items()):
+        score = agreement(ref_counts, counts)
+        worst = min(worst, score)
+        print("%-6s %6d: agreement %.2f over the corpus (minimum %.2f)"
+              % (engine, rate, score, args.min_agreement))
+    return 1 if worst < args.min_agreement else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+"""
+Compare the streaming calibration sketch with exact np.percentile calibration.
+
+    python -m benchmarks.calibration_report [audio files...] [--rel-error 0.01]
+
+Without arguments the corpus is synthesized: the demo song in every wave
+type, a few random scores and white noise.
+"""
+import argparse
+
+import numpy as np
+
+import notemapper
+from benchmarks.parser_throughput import synthetic_ptttl
+from main import rtttl_str
+from ptttl import audio
+from ptttl.parser import PTTTLParser
+from tones import SINE_WAVE, SQUARE_WAVE, TRIANGLE_WAVE, SAWTOOTH_WAVE
+
+
+def synthetic_corpus():
+    waves = [('sine', SINE_WAVE), ('square', SQUARE_WAVE),
+             ('triangle', TRIANGLE_WAVE), ('sawtooth', SAWTOOTH_WAVE)]
+    for name, wavetype in waves:
+        yield 'demo-%s' % name, audio.ptttl_to_samples(rtttl_str, wavetype=wavetype), audio.SAMPLE_RATE
+
+    for seed in range(3):
+        source = synthetic_ptttl(0.002, 3, seed=seed)
+        data = PTTTLParser().parse(source)
+        yield 'random-%d' % seed, audio.ptttl_data_to_samples(data), audio.SAMPLE_RATE
+
+    noise = np.random.default_rng(0).uniform(-0.5, 0.5, audio.SAMPLE_RATE * 30)
+    yield 'noise', noise.astype(np.float32), audio.SAMPLE_RATE
+
+
+def file_corpus(paths):
+    import librosa
+    for path in paths:
+        samples, sr = librosa.load(path, sr=None, mono=True)
+        yield path, samples, sr
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rel-error', type=float, default=notemapper.CALIBRATION_REL_ERROR)
+    parser.add_argument('files', nargs='*')
+    args = parser.parse_args()
+
+    corpus = file_corpus(args.files) if args.files else synthetic_corpus()
+
+    print("%-16s %5s %12s %12s %9s %8s %s"
+          % ("input", "lane", "exact", "sketch", "rel.err", "buckets", "chart"))
+
+    worst = 0.0
+    charts_equal = 0
+    total = 0
+    for name, samples, sr in corpus:
+        buffer_size = notemapper.NOTE_CONFIG['BUFFERSIZE']
+        peaks = notemapper._frame_lane_peaks(np.asarray(samples, dtype=np.float32), buffer_size)
+        sketches = notemapper._new_sketches('sketch', args.rel_error)
+        notemapper._update_sketches(sketches, peaks)
+
+        exact_map = notemapper.create_note_map_from_samples(samples, sr, 'exact')
+        sketch_map = notemapper.create_note_map_from_samples(samples, sr, 'sketch',
+                                                           calibration_rel_error=args.rel_error)
+        same = exact_map[:2] == sketch_map[:2]
+        charts_equal += same
+        total += 1
+
+        for lane, (exact, est) in enumerate(zip(exact_map[2], sketch_map[2])):
+            err = abs(est - exact) / exact if exact else 0.0
+            worst = max(worst, err)
+            print("%-16s %5d %12.4f %12.4f %8.3f%% %8d %s"
+                  % (name[-16:], lane, exact, est, 100.0 * err, len(sketches[lane]),
+                     "same" if same else "differs (%d vs %d notes)"
+                     % (len(exact_map[0]), len(sketch_map[0]))))
+
+    print("\nworst relative error: %.3f%% (bound %.3f%%), identical charts: %d/%d"
+          % (100.0 * worst, 100.0 * args.rel_error, charts_equal, total))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Speed and onset accuracy of the note-map backends, scored against the note
+starts of the parsed RTTTL that produced the audio.
+
+    python -m benchmarks.onset_accuracy [--tolerance-ms 50] [--songs 6] [--repeat 3]
+
+A detection is a hit when a true onset lies within the tolerance. Charts are
+thinned by the cooldown/gap rules, so their recall is bounded; the raw flux
+onsets (before those rules) show what the detector itself finds.
+"""
+import argparse
+import time
+
+import numpy as np
+
+import notemapper
+from benchmarks.parser_throughput import synthetic_ptttl
+from main import rtttl_str
+from ptttl import audio
+from ptttl.parser import PTTTLParser
+
+
+def true_onsets_ms(data):
+    onsets = []
+    for track in data.track_arrays:
+        counts = audio.note_sample_counts(track)
+        starts = np.cumsum(counts) - counts
+        onsets.append(starts[track.pitch > 0] * 1000.0 / audio.SAMPLE_RATE)
+    if not onsets:
+        return np.zeros(0)
+    return np.unique(np.concatenate(onsets))
+
+
+def score(detected_ms, truth_ms, tolerance_ms):
+    detected = np.asarray(detected_ms, dtype=np.float64)
+    if not len(detected) or not len(truth_ms):
+        return 0.0, 0.0
+
+    def nearest_distance(points, reference):
+        idx = np.clip(np.searchsorted(reference, points), 1, len(reference) - 1)
+        if len(reference) == 1:
+            return np.abs(points - reference[0])
+        return np.minimum(np.abs(points - reference[idx - 1]), np.abs(points - reference[idx]))
+
+    precision = np.mean(nearest_distance(detected, truth_ms) <= tolerance_ms)
+    recall = np.mean(nearest_distance(truth_ms, np.sort(detected)) <= tolerance_ms)
+    return precision, recall
+
+
+def corpus(songs):
+    yield 'demo', rtttl_str
+    for seed in range(songs - 1):
+        yield 'random-%d' % seed, synthetic_ptttl(0.0015, 1 + seed % 3, seed=seed)
+
+
+def timed(func, repeat, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tolerance-ms', type=float, default=50.0)
+    parser.add_argument('--songs', type=int, default=6)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print("%-10s %6s | %-26s | %-26s | %-16s"
+          % ("song", "onsets", "peaks chart  P / R / ms", "flux chart  P / R / ms", "flux raw  P / R"))
+
+    totals = {'peaks': [0.0, 0.0], 'flux': [0.0, 0.0]}
+    for name, source in corpus(args.songs):
+        data = PTTTLParser().parse(source)
+        samples = audio.ptttl_data_to_samples(data)
+        truth = true_onsets_ms(data)
+        sr = audio.SAMPLE_RATE
+
+        peaks_map, peaks_time = timed(notemapper.NOTE_MAP_BACKENDS['peaks'], args.repeat, samples, sr)
+        flux_map, flux_time = timed(notemapper.NOTE_MAP_BACKENDS['flux'], args.repeat, samples, sr)
+        totals['peaks'][0] += peaks_time
+        totals['flux'][0] += flux_time
+        totals['peaks'][1] += len(samples) / float(sr)
+        totals['flux'][1] += len(samples) / float(sr)
+
+        pp, pr = score(peaks_map[1], truth, args.tolerance_ms)
+        fp, fr = score(flux_map[1], truth, args.tolerance_ms)
+        rp, rr = score(flux_map[2], truth, args.tolerance_ms)
+        print("%-10s %6d | %5.2f / %5.2f / %7.1f   | %5.2f / %5.2f / %7.1f   | %5.2f / %5.2f"
+              % (name, len(truth), pp, pr, peaks_time * 1000, fp, fr, flux_time * 1000, rp, rr))
+
+    for engine, (elapsed, audio_secs) in sorted(totals.items()):
+        print("%s: %.0fx real time" % (engine, audio_secs / elapsed))
+
+
+if __name__ == "__main__":
+    main()
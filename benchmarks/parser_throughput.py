@@ -0,0 +1,68 @@
+"""
+Parser throughput on large synthetic PTTTL scores.
+
+    python -m benchmarks.parser_throughput [--megabytes 4] [--tracks 4] [--repeat 3]
+"""
+import argparse
+import random
+import time
+
+from ptttl.parser import PTTTLParser
+
+NOTE_NAMES = ['c', 'c#', 'd', 'd#', 'e', 'f', 'f#', 'g', 'g#', 'a', 'a#', 'b', 'p']
+DURATIONS = ['', '1', '2', '4', '8', '16', '32']
+
+
+def synthetic_ptttl(megabytes, tracks, seed=0):
+    rng = random.Random(seed)
+    target = int(megabytes * 1024 * 1024)
+    parts = ["bench:d=4,o=5,b=140,f=7,v=10:\n"]
+    size = len(parts[0])
+
+    while size < target:
+        block = []
+        for _ in range(tracks):
+            notes = []
+            for _ in range(16):
+                note = rng.choice(DURATIONS) + rng.choice(NOTE_NAMES)
+                if note[-1] != 'p':
+                    note += str(rng.randint(3, 7))
+                if rng.random() < 0.1:
+                    note += '.'
+                if rng.random() < 0.05:
+                    note += 'v'
+                notes.append(note)
+            block.append(', '.join(notes))
+        text = ' |\n'.join(block) + ';\n'
+        parts.append(text)
+        size += len(text)
+
+    return ''.join(parts).rstrip(';\n')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--megabytes', type=float, default=4.0)
+    parser.add_argument('--tracks', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    source = synthetic_ptttl(args.megabytes, args.tracks)
+    ptttl = PTTTLParser()
+
+    best = None
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        data = ptttl.parse(source)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    numnotes = sum(len(t) for t in data.track_arrays)
+    mb = len(source) / (1024.0 * 1024.0)
+    print("source: %.2f MB, %d tracks, %d notes" % (mb, len(data.track_arrays), numnotes))
+    print("best of %d: %.3fs  (%.2f MB/s, %.0f notes/s)"
+          % (args.repeat, best, mb / best, numnotes / best))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from main import ANALYSIS_VERSION
+from notemapper import FLUX_CONFIG, NOTE_CONFIG
+from ptttl import audio
+from ptttl.parser import clean_source
+
+
+def normalize_rtttl(rtttl_source: str) -> str:
+    # Comment lines, line breaks and whitespace around separators don't
+    # change how the parser reads a tune, so they shouldn't change the cache
+    # key either. Case is kept: note names are case-sensitive.
+    return re.sub(r"\s*([,:;|=])\s*", r"\1", clean_source(rtttl_source))
+
+
+def artifact_key(rtttl_source: str, mode: str = "audio", analysis_rate: Optional[int] = None) -> str:
+    """Content hash of everything that affects analyse_song's result.
+
+    The song number is deliberately left out: the song{N}_ prefix is applied
+    by render_song_artifacts, so all song numbers share one entry.
+    """
+    payload = {
+        "version": ANALYSIS_VERSION,
+        "rtttl": normalize_rtttl(rtttl_source),
+        "mode": mode,
+        "note_config": NOTE_CONFIG,
+        "flux_config": FLUX_CONFIG,
+        "sample_rate": audio.SAMPLE_RATE,
+        "analysis_rate": analysis_rate,
+        "synth_engine": audio.SYNTH_ENGINE,
+    }
+    blob = json.dumps(payload, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(blob).hexdigest()
+
+
+class ArtifactCache:
+    """
+    Two-tier cache of analyse_song results: an in-memory LRU bounded by entry
+    count and (serialized) bytes, and an optional directory of JSON files
+    that survives restarts.
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 16 * 1024 * 1024,
+                 disk_dir: Optional[str] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key + ".json")
+
+    def _store(self, key: str, value: dict, size: int):
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[1]
+        self._entries[key] = (value, size)
+        self._bytes += size
+
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, (_, old_size) = self._entries.popitem(last=False)
+            self._bytes -= old_size
+            self.evictions += 1
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return entry[0]
+
+        if self.disk_dir is not None:
+            try:
+                with open(self._disk_path(key), "r") as fh:
+                    blob = fh.read()
+                value = json.loads(blob)
+            except (OSError, ValueError):
+                value = None
+
+            if value is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                    self._store(key, value, len(blob))
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, value: dict):
+        blob = json.dumps(value)
+        with self._lock:
+            self._store(key, value, len(blob))
+
+        if self.disk_dir is not None:
+            # Write then rename so a concurrent reader never sees a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+            with os.fdopen(fd, "w") as fh:
+                fh.write(blob)
+            os.replace(tmp_path, self._disk_path(key))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
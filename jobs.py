@@ -0,0 +1,170 @@
+import multiprocessing
+import queue
+import threading
+import time
+from typing import Optional
+
+
+class PoolBusy(Exception):
+    """Raised by JobPool.run when every worker is busy and the queue is full."""
+    pass
+
+
+class JobTimeout(Exception):
+    """Raised by JobPool.run when a job overruns; its worker has been killed."""
+    pass
+
+
+def _worker_loop(conn):
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+
+        func, args, kwargs = job
+        try:
+            conn.send((True, func(*args, **kwargs)))
+        except Exception as e:
+            try:
+                conn.send((False, e))
+            except Exception:
+                # The exception itself may not pickle
+                conn.send((False, RuntimeError(repr(e))))
+
+
+class _Worker:
+    def __init__(self, ctx):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_loop, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class JobPool:
+    """
+    Fixed set of worker processes with a bounded wait queue.
+
+    run() blocks the calling thread (not the CPU) until a worker is free and
+    the job is done. At most ``workers + queue_depth`` jobs are admitted at
+    once; beyond that PoolBusy is raised immediately so the caller can shed
+    load. A job running longer than ``timeout`` seconds gets its worker
+    killed and replaced, and JobTimeout is raised.
+
+    close() waits up to ``shutdown_grace`` seconds for running jobs, then
+    kills the workers still busy with them.
+    """
+
+    def __init__(self, workers: int, queue_depth: int, timeout: Optional[float] = None,
+                 shutdown_grace: float = 5.0):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.timeout = timeout
+        self.shutdown_grace = shutdown_grace
+        self._ctx = multiprocessing.get_context("spawn")
+        self._admission = threading.BoundedSemaphore(workers + queue_depth)
+        self._idle = queue.Queue()
+        # Every live worker, idle or busy, so close() can reach busy ones
+        self._live = set()
+        self._live_lock = threading.Lock()
+        self._closed = False
+        for _ in range(workers):
+            self._idle.put(self._spawn())
+
+    def _spawn(self):
+        worker = _Worker(self._ctx)
+        with self._live_lock:
+            self._live.add(worker)
+        return worker
+
+    def _discard(self, worker):
+        with self._live_lock:
+            self._live.discard(worker)
+        worker.kill()
+
+    def _replace(self, worker):
+        # A worker that timed out or died; no replacement once closing
+        self._discard(worker)
+        return None if self._closed else self._spawn()
+
+    def run(self, func, *args, **kwargs):
+        if self._closed:
+            raise RuntimeError("job pool is closed")
+        if not self._admission.acquire(blocking=False):
+            raise PoolBusy("all %d workers busy and %d jobs queued"
+                           % (self.workers, self.queue_depth))
+        return self._run_admitted(func, args, kwargs)
+
+    def run_when_free(self, func, *args, **kwargs):
+        """Like run(), but waits for a queue slot instead of raising PoolBusy."""
+        if self._closed:
+            raise RuntimeError("job pool is closed")
+        self._admission.acquire()
+        return self._run_admitted(func, args, kwargs)
+
+    def _run_admitted(self, func, args, kwargs):
+        try:
+            worker = self._idle.get()
+            if worker is None:
+                # close() woke up jobs still waiting for a worker
+                self._idle.put(None)
+                raise RuntimeError("job pool is closed")
+            try:
+                worker.conn.send((func, args, kwargs))
+                if not worker.conn.poll(self.timeout):
+                    worker = self._replace(worker)
+                    raise JobTimeout("job exceeded %.1fs" % self.timeout)
+                ok, result = worker.conn.recv()
+            except (EOFError, OSError):
+                # The worker died (or close() killed it) underneath us
+                worker = self._replace(worker)
+                raise RuntimeError("worker process died")
+            finally:
+                if worker is not None:
+                    self._idle.put(worker)
+        finally:
+            self._admission.release()
+
+        if not ok:
+            raise result
+        return result
+
+    def close(self):
+        self._closed = True
+        deadline = time.monotonic() + self.shutdown_grace
+        while True:
+            with self._live_lock:
+                if not self._live:
+                    break
+            try:
+                worker = self._idle.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if worker is None:
+                continue
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+            worker.process.join(timeout=1)
+            self._discard(worker)
+
+        # Workers still running a job past the grace period. Only the process
+        # is killed here: the thread waiting on the job sees the pipe close
+        # and cleans up the rest.
+        with self._live_lock:
+            busy = list(self._live)
+            self._live.clear()
+        for worker in busy:
+            worker.process.kill()
+            worker.process.join()
+
+        # Jobs still queued for a worker fail instead of waiting forever
+        self._idle.put(None)
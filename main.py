@@ -1,38 +1,90 @@
-from rtttl import RTTTL
-from ptttl.audio import ptttl_to_mp3
-from notemapper import create_auto_note_map
+from typing import Optional
+
+import numpy as np
+
+from ptttl.parser import PTTTLParser, PTTTLTrack
+from ptttl.audio import SAMPLE_RATE, note_sample_counts, ptttl_data_to_samples, samples_to_mp3
+from notemapper import (NOTE_MAP_BACKENDS, REFERENCE_SAMPLE_RATE, check_analysis_rate,
+                        create_score_note_map)
+
+# "audio" and "flux" analyse the synthesized audio with the notemapper
+# backend of that name; "score" maps lanes from the parsed notes
+NOTE_MAP_MODES = ("audio", "score", "flux")
+AUDIO_BACKENDS = {"audio": "peaks", "flux": "flux"}
+
+# Bump when analyse_song's output changes so stale cache entries are ignored
+ANALYSIS_VERSION = 2
 
 rtttl_str = "Cantina:d=4, o=5, b=250:8a, 8p, 8d6, 8p, 8a, 8p, 8d6, 8p, 8a, 8d6, 8p, 8a, 8p, 8g#, a, 8a, 8g#, 8a, g, 8f#, 8g, 8f#, f., 8d., 16p, p., 8a, 8p, 8d6, 8p, 8a, 8p, 8d6, 8p, 8a, 8d6, 8p, 8a, 8p, 8g#, 8a, 8p, 8g, 8p, g., 8f#, 8g, 8p, 8c6, a#, a, g"
 song_num = 2
 
-def generate_song_artifacts(rtttl_source: str, output_mp3: str, song_id: int = 2) -> str:
-    ptttl_to_mp3(rtttl_source, output_mp3)
-    lanes, times, _ = create_auto_note_map(output_mp3)
+def analyse_song(rtttl_source: str, output_mp3: Optional[str] = None, mode: str = "audio",
+                 analysis_rate: Optional[int] = None) -> dict:
+    """Compute the song-number-independent arrays behind the C artifacts.
+
+    analysis_rate synthesizes the audio handed to the note mapper at that
+    sample rate instead of SAMPLE_RATE; 22050 halves the analysis cost (see
+    benchmarks/analysis_rate.py for how charts compare). Rates below
+    notemapper.MIN_ANALYSIS_RATE raise ValueError.
+    The MP3 is always rendered at SAMPLE_RATE.
+    """
+    if mode not in NOTE_MAP_MODES:
+        raise ValueError(f"unknown note map mode '{mode}', expected one of {NOTE_MAP_MODES}")
+    if analysis_rate is not None:
+        check_analysis_rate(analysis_rate)
+
+    # One parse feeds the synth, the note mapper and the C arrays. The first
+    # track is the melody; its ticks are the note onsets in the rendered audio.
+    data = PTTTLParser().parse(rtttl_source)
+    melody = data.track_arrays[0] if data.track_arrays else PTTTLTrack([], [])
 
-    rtttl = RTTTL(rtttl_source)
+    offsets = np.concatenate(([0], np.cumsum(note_sample_counts(melody))))
+    ticks = [int(o * 1000 / SAMPLE_RATE) for o in offsets.tolist()]
+    fs = np.where(melody.pitch > 0, melody.pitch, 0.0).tolist()
 
-    fs, ds = zip(*[t for t in rtttl.notes()])
-    fs, ds = list(fs), list(ds)
+    # Audio is only synthesized when it is analysed or an MP3 is asked for
+    analysis_rate = analysis_rate or SAMPLE_RATE
+    samples = None
+    if output_mp3 is not None:
+        samples = ptttl_data_to_samples(data)
+        samples_to_mp3(samples, output_mp3)
+    if mode in AUDIO_BACKENDS and (samples is None or analysis_rate != SAMPLE_RATE):
+        samples = ptttl_data_to_samples(data, sample_rate=analysis_rate)
 
+    if mode == "score":
+        lanes, times, _ = create_score_note_map(zip(ticks, fs))
+    else:
+        lanes, times, _ = NOTE_MAP_BACKENDS[AUDIO_BACKENDS[mode]](
+            samples, analysis_rate, reference_rate=REFERENCE_SAMPLE_RATE)
+
+    return {
+        "melody": [int(round(f)) for f in fs] + [0],
+        "note_ticks": ticks,
+        "lanes": [int(l) for l in lanes],
+        "tickNs": [int(t/10) for t in times],
+    }
+
+
+def render_song_artifacts(analysis: dict, song_id: int = 2) -> str:
+    """Format an analyse_song result as C arrays prefixed with song{song_id}_."""
     lines = []
-    melody = ",".join(str(int(f)) for f in fs) + ",0"
+    melody = ",".join(map(str, analysis["melody"]))
     lines.append(f"static const int song{song_id}_melody[]={{{melody}}};")
+    lines.append(f"static const int song{song_id}_note_ticks[]={{{','.join(map(str, analysis['note_ticks']))}}};")
 
-    t = 0
-    ticks = []
-    for d in ds:
-        ticks.append(str(int(t)))
-        t += d
-    ticks.append(str(int(t)))
-    lines.append(f"static const int song{song_id}_note_ticks[]={{{','.join(ticks)}}};")
-
+    lanes = analysis["lanes"]
     lines.append(f"static const int song{song_id}_lanes[] = {{{', '.join(map(str, lanes))}}};")
-    lines.append(f"static const int song{song_id}_tickNs[] = {{{', '.join(map(str, (int(t/10) for t in times)))}}};")
+    lines.append(f"static const int song{song_id}_tickNs[] = {{{', '.join(map(str, analysis['tickNs']))}}};")
     lines.append(f"static const int song{song_id}_num_notes={len(lanes)};")
 
     return "\n".join(lines)
 
 
+def generate_song_artifacts(rtttl_source: str, output_mp3: Optional[str] = None, song_id: int = 2,
+                            mode: str = "audio", analysis_rate: Optional[int] = None) -> str:
+    return render_song_artifacts(analyse_song(rtttl_source, output_mp3, mode, analysis_rate), song_id)
+
+
 if __name__ == "__main__":
     output = generate_song_artifacts(rtttl_str, "audio.mp3", song_num)
     print(output)
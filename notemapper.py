@@ -1,5 +1,10 @@
+import wave
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import librosa
+from numpy.lib.stride_tricks import sliding_window_view
 from scipy.fft import rfft as scipy_rfft
 
 NOTE_CONFIG = {
@@ -13,79 +18,658 @@ NOTE_CONFIG = {
     'RNG_SEED': 42
 }
 
-def create_auto_note_map(file_path):
-    audio_data, sr = librosa.load(file_path, sr=None, mono=True)
-    duration_mins = len(audio_data) / sr / 60
-    
-    num_lanes = 3
-    lane_ranges = [0.10, 0.45, 1.0] 
-    buffer_size = NOTE_CONFIG['BUFFERSIZE']
-    
+LANE_RANGES = [0.10, 0.45, 1.0]
+
+# Sample counts in NOTE_CONFIG and FLUX_CONFIG, and LANE_RANGES (fractions of
+# the Nyquist frequency), are taken as they are at the audio's own rate. When
+# analysis at a chosen rate is asked for (e.g. 22050 Hz for cheap analysis),
+# they are read as given at this rate instead: frames are scaled to the same
+# duration, so ms timings line up, magnitudes scaled back to what a full-size
+# frame would give, so thresholds and floors keep their meaning, and lane
+# edges stay the same in Hz.
+REFERENCE_SAMPLE_RATE = 44100
+# Lowest such analysis rate: its Nyquist frequency has to clear the treble
+# lane's lower edge (LANE_RANGES[-2] of 22050 Hz, about 9.9 kHz)
+MIN_ANALYSIS_RATE = 22050
+
+# Chart profiles for create_auto_note_maps: NOTE_CONFIG overrides per
+# difficulty. Each chart is steered toward its TARGET_NOTES_PER_MINUTE.
+DIFFICULTY_PROFILES = {
+    'easy': {'TARGET_NOTES_PER_MINUTE': 40, 'MIN_NOTE_GAP_MS': 400, 'GLOBAL_COOLDOWN_MS': 250},
+    'normal': {},
+    'hard': {'TARGET_NOTES_PER_MINUTE': 140, 'MIN_NOTE_GAP_MS': 150, 'GLOBAL_COOLDOWN_MS': 80,
+             'STREAK_LIMIT': 3},
+}
+
+# Bisection steps spent searching each profile's threshold scale
+DENSITY_SEARCH_STEPS = 12
+
+# Spectral-flux backend (create_flux_note_map_from_samples)
+FLUX_CONFIG = {
+    'FRAME_SIZE': 2048,
+    'HOP_SIZE': 512,
+    'LOG_COMPRESSION': 10.0,
+    'PEAK_WINDOW': 3,        # Frames either side an onset must dominate
+    'MEAN_WINDOW': 16,       # Frames either side of the adaptive threshold's mean
+    'DELTA': 0.6,            # Threshold above the local mean, in units of the lane's typical flux
+    'SCALE_PERCENTILE': 95,  # Percentile of a lane's flux taken as its typical onset flux
+}
+
+# Lane peaks at or below this are treated as silence during calibration
+SILENCE_FLOOR = 0.1
+CALIBRATION_PERCENTILE = 75
+# Relative error bound of the streaming calibration sketch
+CALIBRATION_REL_ERROR = 0.01
+# Audio a NoteMapper holds back to calibrate on before it emits events
+CALIBRATION_SECS = 30.0
+
+# With workers > 1, spectra are computed in contiguous frame ranges of at
+# least this many frames; shorter ranges cost more to hand out than to run
+PARALLEL_MIN_FRAMES = 32
+
+
+class QuantileSketch:
+    """Constant-memory streaming quantile estimator for positive values.
+
+    Values are counted in logarithmic buckets whose width is set by
+    ``rel_error`` (as in DDSketch), so any quantile is reported within a
+    relative error of ``rel_error`` of the value at that rank, and the number
+    of buckets only depends on the ratio between the largest and smallest
+    value seen: about 580 buckets cover 0.1 to 10000 at 1%.
+    """
+
+    def __init__(self, rel_error=None):
+        if rel_error is None:
+            rel_error = CALIBRATION_REL_ERROR
+        self.rel_error = rel_error
+        self.gamma = (1.0 + rel_error) / (1.0 - rel_error)
+        self._log_gamma = np.log(self.gamma)
+        self._buckets = {}
+        self.count = 0
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[values > 0]
+        if not len(values):
+            return
+        keys, counts = np.unique(np.ceil(np.log(values) / self._log_gamma).astype(np.int64),
+                                 return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self._buckets[key] = self._buckets.get(key, 0) + count
+        self.count += len(values)
+
+    def _value_at(self, rank):
+        seen = 0
+        for key in sorted(self._buckets):
+            seen += self._buckets[key]
+            if seen > rank:
+                return 2.0 * self.gamma ** key / (self.gamma + 1.0)
+
+    def quantile(self, q):
+        """Estimate of the q-th quantile (0 <= q <= 1) of the values seen.
+
+        Interpolates between the two nearest ranks like np.percentile, so the
+        result is within rel_error of the exact percentile.
+        """
+        if not self.count:
+            raise ValueError("quantile of an empty sketch")
+        rank = (self.count - 1) * q
+        lo = int(np.floor(rank))
+        frac = rank - lo
+        value = self._value_at(lo)
+        if frac:
+            value += frac * (self._value_at(lo + 1) - value)
+        return value
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+def _lane_bounds(spectrum_len, lane_ranges=LANE_RANGES):
+    # Bin i belongs to the first lane whose range exceeds i / spectrum_len.
+    # The fractions are evaluated exactly as the old per-bin loop did, so the
+    # boundaries (and therefore the lane peaks) are bit-identical.
+    p = np.arange(spectrum_len) / spectrum_len
+    bounds = [0]
+    for r in lane_ranges[:-1]:
+        bounds.append(int(np.count_nonzero(p < r)))
+    bounds.append(spectrum_len)
+    return bounds
+
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def _get_executor(workers):
+    # Thread pools are kept for the life of the process. scipy's FFT and the
+    # numpy reductions release the GIL, so frame ranges run concurrently.
+    with _executors_lock:
+        executor = _executors.get(workers)
+        if executor is None:
+            executor = ThreadPoolExecutor(workers)
+            _executors[workers] = executor
+        return executor
+
+
+def _map_frame_ranges(func, frames, workers):
+    # func(frames[a:b]) over contiguous row ranges, one per worker, with the
+    # results stacked in order. Every frame's FFT and reduction is computed
+    # on its own, so the result equals func(frames).
+    num_ranges = min(workers, len(frames) // PARALLEL_MIN_FRAMES)
+    if num_ranges <= 1:
+        return func(frames)
+
+    edges = np.linspace(0, len(frames), num_ranges + 1).astype(np.int64)
+    parts = [frames[a:b] for a, b in zip(edges[:-1], edges[1:])]
+    return np.concatenate(list(_get_executor(workers).map(func, parts)))
+
+
+def _lane_peaks(frames, lane_ranges=LANE_RANGES):
+    # Batched rfft over a frame matrix, each lane's bins reduced to their max
+    spectra = np.abs(scipy_rfft(frames, axis=-1))
+
+    bounds = _lane_bounds(spectra.shape[1], lane_ranges)
+    peaks = np.zeros((len(frames), len(lane_ranges)), dtype=spectra.dtype)
+    for l_idx in range(len(lane_ranges)):
+        lo, hi = bounds[l_idx], bounds[l_idx + 1]
+        if hi > lo and len(frames):
+            peaks[:, l_idx] = spectra[:, lo:hi].max(axis=1)
+    return peaks
+
+
+def _frame_lane_peaks(audio_data, buffer_size, lane_ranges=LANE_RANGES, workers=1):
+    # Split the audio into non-overlapping frames (only those followed by at
+    # least one more sample, like the original while-loops) and find each
+    # frame's lane peaks, spread over up to ``workers`` threads.
+    num_frames = max(0, (len(audio_data) - 1) // buffer_size)
+    frames = audio_data[:num_frames * buffer_size].reshape(num_frames, buffer_size)
+    return _map_frame_ranges(lambda part: _lane_peaks(part, lane_ranges), frames, workers)
+
+
+# Samples read from a WAV file at a time; peak memory of create_auto_note_map
+# scales with this rather than with the length of the file
+READ_BLOCK_SAMPLES = 64 * NOTE_CONFIG['BUFFERSIZE']
+
+
+def check_analysis_rate(sample_rate):
+    """Raise ValueError if sample_rate is too low to analyse at."""
+    if sample_rate < MIN_ANALYSIS_RATE:
+        raise ValueError("Analysis sample rate %d Hz is too low; the treble lane needs "
+                         "at least %d Hz" % (sample_rate, MIN_ANALYSIS_RATE))
+
+
+def _scaled_frames(num_samples, sr, reference_rate=None):
+    if reference_rate is None:
+        return num_samples
+    return max(1, int(round(num_samples * sr / float(reference_rate))))
+
+
+def _lane_ranges(sr, reference_rate=None):
+    # LANE_RANGES with the same edges in Hz at this rate. The top lane always
+    # ends at Nyquist.
+    if reference_rate is None:
+        return LANE_RANGES
+    scale = reference_rate / float(sr)
+    return [min(r * scale, 1.0) for r in LANE_RANGES[:-1]] + [1.0]
+
+
+def _frame_chunk(pending, samples, sr, buffer_size, workers=1, reference_rate=None):
+    # Lane peaks of the frames completed by a new chunk of samples, plus the
+    # samples to carry over. A frame is only analysed once at least one more
+    # sample has arrived after it, exactly as _frame_lane_peaks frames a
+    # whole signal. buffer_size is given at reference_rate (None: at sr).
+    frame_size = _scaled_frames(buffer_size, sr, reference_rate)
+    samples = np.asarray(samples, dtype=np.float32)
+    data = np.concatenate([pending, samples]) if len(pending) else samples
+    num_frames = max(0, (len(data) - 1) // frame_size)
+    peaks = _frame_lane_peaks(data[:num_frames * frame_size + 1], frame_size,
+                              _lane_ranges(sr, reference_rate), workers)
+    if frame_size != buffer_size:
+        peaks *= buffer_size / frame_size
+    return peaks, data[num_frames * frame_size:]
+
+
+def _pcm_to_float(raw, sample_width, channels):
+    # Same scaling as librosa/soundfile: full-scale PCM maps to [-1.0, 1.0),
+    # channels are averaged to mono
+    if sample_width == 1:
+        samples = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128.0) / 128.0
+    elif sample_width == 3:
+        b = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        ints = (b[:, 0] << 8) | (b[:, 1] << 16) | (b[:, 2] << 24)
+        samples = (ints / 2147483648.0).astype(np.float32)
+    else:
+        dtype = {2: '<i2', 4: '<i4'}[sample_width]
+        ints = np.frombuffer(raw, dtype=dtype)
+        samples = (ints / float(2 ** (8 * sample_width - 1))).astype(np.float32)
+
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1, dtype=np.float32)
+    return samples
+
+
+def _open_wav(file_path, sample_rate=None):
+    # A wave.Wave_read to stream from, or None when the file has to be
+    # decoded (and resampled) by librosa instead
+    try:
+        wav = wave.open(file_path, 'rb')
+    except (wave.Error, EOFError):
+        return None
+
+    if sample_rate is not None and wav.getframerate() != sample_rate:
+        wav.close()
+        return None
+    return wav
+
+
+def _wav_blocks(wav, block_samples):
+    # Read a wave.Wave_read object block by block
+    while True:
+        raw = wav.readframes(block_samples)
+        if not raw:
+            return
+        yield _pcm_to_float(raw, wav.getsampwidth(), wav.getnchannels())
+
+
+def create_auto_note_map(file_path, calibration='exact', sample_rate=None, workers=1,
+                         calibration_rel_error=None, calibration_secs=None):
+    """Map lanes from an audio file.
+
+    PCM WAV files are read and analysed READ_BLOCK_SAMPLES (times workers) at
+    a time; other formats are decoded in full with librosa.
+
+    ``calibration`` picks how the per-lane base thresholds are found:
+    'exact' takes np.percentile over all lane peaks; 'sketch' feeds each
+    block's peaks to a QuantileSketch as they are computed, so calibration
+    needs no pass of its own, and its thresholds are within
+    ``calibration_rel_error`` (default CALIBRATION_REL_ERROR) of the exact
+    ones. Either way the per-frame peaks (three floats per BUFFERSIZE
+    samples) are kept until calibration, as notes are picked from them
+    afterwards. ``calibration_secs`` calibrates on that much audio instead
+    of the whole file (as NoteMapper does), which bounds that table.
+
+    ``sample_rate`` resamples the audio to that rate before analysis (None
+    keeps the file's rate and analyses it as it always has). Frames and lane
+    edges then keep their length in ms and Hz at REFERENCE_SAMPLE_RATE, so
+    22050 Hz gives comparable charts at about half the FFT cost. Rates below
+    MIN_ANALYSIS_RATE raise ValueError.
+
+    ``workers`` > 1 computes the spectra and lane peaks of contiguous frame
+    ranges on that many threads; only the threshold/cooldown pass stays
+    serial. The result is identical to workers=1.
+    """
+    reference_rate = _reference_rate(sample_rate)
+    wav = _open_wav(file_path, sample_rate)
+    if wav is None:
+        audio_data, sr = librosa.load(file_path, sr=sample_rate, mono=True)
+        return create_note_map_from_samples(audio_data, sr, calibration, workers,
+                                            calibration_rel_error, calibration_secs,
+                                            reference_rate)
+
+    with wav:
+        sr = wav.getframerate()
+        mapper = NoteMapper(sr, calibration_secs=calibration_secs, calibration=calibration,
+                            workers=workers, calibration_rel_error=calibration_rel_error,
+                            reference_rate=reference_rate)
+        events = []
+        for block in _wav_blocks(wav, READ_BLOCK_SAMPLES * workers):
+            events += mapper.feed(block)
+        events += mapper.close()
+
+    return [e[0] for e in events], [e[1] for e in events], mapper.auto_thresholds
+
+
+def create_note_map_from_samples(audio_data, sr, calibration='exact', workers=1,
+                                 calibration_rel_error=None, calibration_secs=None,
+                                 reference_rate=None):
+    """Same as create_auto_note_map, but on mono samples already in memory.
+
+    Pass ``reference_rate=REFERENCE_SAMPLE_RATE`` for audio analysed at a
+    chosen rate (the equivalent of create_auto_note_map's sample_rate).
+    """
+    mapper = NoteMapper(sr, calibration_secs=calibration_secs, calibration=calibration,
+                        workers=workers, calibration_rel_error=calibration_rel_error,
+                        reference_rate=reference_rate)
+    events = mapper.feed(audio_data) + mapper.close()
+    return [e[0] for e in events], [e[1] for e in events], mapper.auto_thresholds
+
+
+def create_auto_note_maps(file_path, profiles=None, sample_rate=None, workers=1):
+    """Map lanes from an audio file once per chart profile.
+
+    The spectra are computed once (WAV input is streamed as in
+    create_auto_note_map); every profile then runs its own threshold state
+    machine over the same lane peaks. ``profiles`` maps chart names to
+    NOTE_CONFIG overrides and defaults to DIFFICULTY_PROFILES. Base
+    thresholds are scaled per profile so the chart lands as close as
+    possible to its TARGET_NOTES_PER_MINUTE. That search replays every
+    frame, so the lane peaks are kept and calibration is always exact.
+    ``sample_rate`` and ``workers`` are as in create_auto_note_map.
+
+    Returns {name: (lane_indices, timestamps_ms, thresholds)}.
+    """
+    reference_rate = _reference_rate(sample_rate)
+    wav = _open_wav(file_path, sample_rate)
+    if wav is None:
+        audio_data, sr = librosa.load(file_path, sr=sample_rate, mono=True)
+        return create_note_maps_from_samples(audio_data, sr, profiles, workers, reference_rate)
+
+    with wav:
+        sr = wav.getframerate()
+        num_samples = wav.getnframes()
+        pending = np.zeros(0, dtype=np.float32)
+        frame_peaks = []
+        for block in _wav_blocks(wav, READ_BLOCK_SAMPLES * workers):
+            peaks, pending = _frame_chunk(pending, block, sr, NOTE_CONFIG['BUFFERSIZE'], workers,
+                                          reference_rate)
+            frame_peaks.append(peaks)
+
+    if frame_peaks:
+        frame_peaks = np.concatenate(frame_peaks)
+    else:
+        frame_peaks = np.zeros((0, len(LANE_RANGES)), dtype=np.float32)
+    return _note_maps_from_peaks(frame_peaks, sr, num_samples, profiles, reference_rate)
+
+
+def create_note_maps_from_samples(audio_data, sr, profiles=None, workers=1,
+                                  reference_rate=None):
+    """Same as create_auto_note_maps, but on mono samples already in memory.
+
+    ``reference_rate`` is as in create_note_map_from_samples.
+    """
+    if reference_rate is not None:
+        check_analysis_rate(sr)
+    frame_peaks, _ = _frame_chunk(np.zeros(0, dtype=np.float32), audio_data, sr,
+                                  NOTE_CONFIG['BUFFERSIZE'], workers, reference_rate)
+    return _note_maps_from_peaks(frame_peaks, sr, len(audio_data), profiles, reference_rate)
+
+
+def _reference_rate(sample_rate):
+    # Frames and lane edges are only rescaled when a rate was asked for
+    if sample_rate is None:
+        return None
+    check_analysis_rate(sample_rate)
+    return REFERENCE_SAMPLE_RATE
+
+
+def _note_maps_from_peaks(frame_peaks, sr, num_samples, profiles, reference_rate=None):
+    if profiles is None:
+        profiles = DIFFICULTY_PROFILES
+
+    base = _auto_thresholds(frame_peaks)
+    duration_mins = num_samples / sr / 60
+
+    charts = {}
+    for name, overrides in profiles.items():
+        config = dict(NOTE_CONFIG, **overrides)
+        target = config['TARGET_NOTES_PER_MINUTE'] * duration_mins
+
+        def run(scale):
+            mapper = NoteMapper(sr, auto_thresholds=[t * scale for t in base], config=config,
+                                reference_rate=reference_rate)
+            return mapper._generate(frame_peaks), mapper.auto_thresholds
+
+        # Fewer notes as the thresholds go up (near enough: the cooldowns
+        # and the RNG make it not strictly monotonic), so bisect the scale
+        # in log space and keep the closest chart seen
+        lo, hi = -6.0, 6.0
+        best = None
+        for _ in range(DENSITY_SEARCH_STEPS):
+            mid = (lo + hi) / 2
+            events, thresholds = run(2.0 ** mid)
+            if best is None or abs(len(events) - target) < abs(len(best[0]) - target):
+                best = (events, thresholds)
+            if len(events) > target:
+                lo = mid
+            elif len(events) < target:
+                hi = mid
+            else:
+                break
+
+        events, thresholds = best
+        charts[name] = ([e[0] for e in events], [e[1] for e in events], thresholds)
+
+    return charts
+
+
+def _new_sketches(calibration, rel_error=None):
+    if calibration == 'exact':
+        return None
+    if calibration != 'sketch':
+        raise ValueError("Invalid calibration: %s" % calibration)
+    return [QuantileSketch(rel_error) for _ in LANE_RANGES]
+
+
+def _update_sketches(sketches, frame_peaks):
+    for sketch, col in zip(sketches, frame_peaks.T):
+        sketch.update(col[col > SILENCE_FLOOR])
+
+
+def _auto_thresholds(frame_peaks, sketches=None):
     # --- PHASE 1: AUTO-CALIBRATION ---
-    # Scan the song to find the "typical" peak for each lane
-    all_peaks = [[], [], []]
-    start = 0
-    while start + buffer_size < len(audio_data):
-        chunk = audio_data[start : start + buffer_size]
-        spectrum = np.abs(scipy_rfft(chunk))
-        spectrum_len = len(spectrum)
-        
-        lane_peaks = [0.0, 0.0, 0.0]
-        for i in range(spectrum_len):
-            p = i / spectrum_len
-            idx = 0 if p < lane_ranges[0] else 1 if p < lane_ranges[1] else 2
-            if spectrum[i] > lane_peaks[idx]:
-                lane_peaks[idx] = spectrum[i]
-        
-        for i in range(3):
-            if lane_peaks[i] > 0.1: # Ignore silence
-                all_peaks[i].append(lane_peaks[i])
-        start += buffer_size
-
-    # Set base thresholds to the 75th percentile of peaks for each lane
-    # This ensures Lane 2 (Treble) gets a fair threshold even if it's quiet
-    auto_thresholds = [np.percentile(p, 75) if p else 10.0 for p in all_peaks]
-    current_thresholds = list(auto_thresholds)
-    
-    # --- PHASE 2: NOTE GENERATION ---
+    # Find the "typical" peak for each lane. Set base thresholds to the 75th
+    # percentile of peaks for each lane, ignoring silence. This ensures
+    # Lane 2 (Treble) gets a fair threshold even if it's quiet. Thresholds
+    # are float32 like the peaks, whichever way they are found
+    if sketches is not None:
+        return [np.float32(s.quantile(CALIBRATION_PERCENTILE / 100.0) if s.count else 10.0)
+                for s in sketches]
+
+    all_peaks = [col[col > SILENCE_FLOOR] for col in frame_peaks.T]
+    return [np.float32(np.percentile(p, CALIBRATION_PERCENTILE) if len(p) else 10.0)
+            for p in all_peaks]
+
+
+class NoteMapper:
+    """Incremental version of create_auto_note_map for live or very long audio.
+
+    Feed mono samples in chunks of any size; each call returns the
+    (lane, timestamp_ms) events that became final. Thresholds, cooldowns,
+    lane history and the RNG are kept between calls, so the events are the
+    same however the audio is split up.
+
+    Lane thresholds are calibrated from the frames seen so far once
+    ``calibration_secs`` of audio (default CALIBRATION_SECS) has arrived;
+    frames up to that point are held back, after which events lag the input
+    by at most one frame. calibration_secs=None calibrates on the whole song
+    at close(): the result then equals create_note_map_from_samples (as it
+    does for audio fed in one call), but no events come out until the end
+    and the held frames grow with the input.
+    Pass ``auto_thresholds`` to skip calibration altogether,
+    ``calibration_rel_error`` to set the error bound of calibration='sketch',
+    ``config`` to override NOTE_CONFIG entries for this mapper,
+    ``workers`` to compute the spectra of each chunk on that many threads,
+    and ``reference_rate`` as in create_note_map_from_samples.
+    """
+
+    def __init__(self, sr, calibration_secs=CALIBRATION_SECS, calibration='exact',
+                 auto_thresholds=None,
+                 config=None, workers=1, calibration_rel_error=None, reference_rate=None):
+        if reference_rate is not None:
+            check_analysis_rate(sr)
+        self.sr = sr
+        self.workers = workers
+        self.reference_rate = reference_rate
+        self.config = dict(NOTE_CONFIG, **(config or {}))
+        self.buffer_size = _scaled_frames(self.config['BUFFERSIZE'], sr, reference_rate)
+        self.calibration_frames = None
+        if calibration_secs is not None:
+            self.calibration_frames = max(1, int(calibration_secs * sr) // self.buffer_size)
+
+        self.auto_thresholds = None
+        self._sketches = _new_sketches(calibration, calibration_rel_error)
+        self._pending = np.zeros(0, dtype=np.float32)
+        self._held = []
+        self._num_held = 0
+        self._frame = 0
+
+        num_lanes = len(LANE_RANGES)
+        self._last_note_time = [-1000] * num_lanes
+        self._global_last_note_time = -1000
+        self._lane_history = []
+        self._rng = np.random.default_rng(self.config['RNG_SEED'])
+
+        if auto_thresholds is not None:
+            self._calibrated(list(auto_thresholds))
+
+    def _calibrated(self, auto_thresholds):
+        self.auto_thresholds = auto_thresholds
+        self._current_thresholds = list(auto_thresholds)
+
+    def feed(self, samples):
+        """Analyse the next chunk of mono samples.
+
+        :return: list of (lane, timestamp_ms) events
+        """
+        peaks, self._pending = _frame_chunk(self._pending, samples, self.sr,
+                                          self.config['BUFFERSIZE'], self.workers,
+                                          self.reference_rate)
+        num_frames = len(peaks)
+        if not num_frames:
+            return []
+
+        if self.auto_thresholds is not None:
+            return self._generate(peaks)
+
+        # --- PHASE 1: AUTO-CALIBRATION ---
+        if self._sketches is not None:
+            _update_sketches(self._sketches, peaks)
+        self._held.append(peaks)
+        self._num_held += num_frames
+
+        if self.calibration_frames is not None and self._num_held >= self.calibration_frames:
+            return self._calibrate()
+        return []
+
+    def close(self):
+        """Finish the stream: calibrate if that hasn't happened yet.
+
+        The trailing partial frame (and a final frame with nothing after
+        it) is not analysed, as in the batch function.
+
+        :return: list of the remaining (lane, timestamp_ms) events
+        """
+        self._pending = np.zeros(0, dtype=np.float32)
+        if self.auto_thresholds is None:
+            return self._calibrate()
+        return []
+
+    def _calibrate(self):
+        if self._held:
+            held = np.concatenate(self._held)
+        else:
+            held = np.zeros((0, len(LANE_RANGES)), dtype=np.float32)
+        self._held = []
+        self._num_held = 0
+
+        self._calibrated(_auto_thresholds(held, self._sketches))
+        return self._generate(held)
+
+    def _generate(self, frame_peaks):
+        # --- PHASE 2: NOTE GENERATION ---
+        num_lanes = len(LANE_RANGES)
+        config = self.config
+        streak = config['STREAK_LIMIT']
+        auto_thresholds = self.auto_thresholds
+        current_thresholds = self._current_thresholds
+        last_note_time = self._last_note_time
+        lane_history = self._lane_history
+        events = []
+
+        for lane_peaks in frame_peaks:
+            frame = self._frame
+            self._frame += 1
+            if frame < 3:
+                continue
+
+            start = frame * self.buffer_size
+            current_ms = int((start / self.sr) * 1000)
+
+            best_lane = -1
+            max_strength = 0
+
+            if (current_ms - self._global_last_note_time) > config['GLOBAL_COOLDOWN_MS']:
+                check_order = [0, 1, 2]
+                self._rng.shuffle(check_order)
+
+                for l_idx in check_order:
+                    strength = lane_peaks[l_idx] - current_thresholds[l_idx]
+
+                    if strength > 0 and strength > max_strength:
+                        if len(lane_history) >= streak:
+                            if all(x == l_idx for x in lane_history[-streak:]):
+                                continue
+
+                        if (current_ms - last_note_time[l_idx]) > config['MIN_NOTE_GAP_MS']:
+                            max_strength = strength
+                            best_lane = l_idx
+
+            if best_lane != -1:
+                events.append((best_lane, current_ms))
+                lane_history.append(best_lane)
+                del lane_history[:-streak]
+                last_note_time[best_lane] = current_ms
+                self._global_last_note_time = current_ms
+
+                # Use UP_MOD to prevent double-hits
+                current_thresholds[best_lane] *= config['UP_MOD']
+
+            # Recovery based on the auto-calculated base
+            for l_idx in range(num_lanes):
+                if current_thresholds[l_idx] > auto_thresholds[l_idx]:
+                    current_thresholds[l_idx] -= (auto_thresholds[l_idx] * config['RECOVERY_RATE'])
+
+        return events
+
+def create_score_note_map(notes):
+    """Map lanes straight from a parsed score, without synthesizing any audio.
+
+    ``notes`` is a sequence of (start_ms, frequency_hz) pairs in time order;
+    rests have a frequency of 0. Each note onset is assigned a lane from the
+    song's own pitch bands (low/mid/high thirds), then the same cooldown, gap
+    and streak rules as the audio mapper are applied. Returns
+    (lanes, timestamps_ms, band_edges_hz).
+    """
+    onsets = [(int(start), freq) for start, freq in notes if freq > 0]
+
+    if not onsets:
+        return [], [], []
+
+    pitches = np.array([freq for _, freq in onsets])
+    band_edges = list(np.percentile(pitches, [100.0 / 3, 200.0 / 3]))
+    preferred_lanes = np.searchsorted(band_edges, pitches, side='left')
+
+    lane_indices, timestamps_ms = _place_onsets([t for t, _ in onsets], preferred_lanes)
+    return lane_indices, timestamps_ms, band_edges
+
+
+def _place_onsets(onset_ms, preferred_lanes, num_lanes=3):
+    # Give each onset its preferred lane, or another lane in random order
+    # when that one is blocked, under the audio mapper's cooldown, gap and
+    # streak rules
     lane_indices = []
     timestamps_ms = []
-    last_note_time = [-1000] * num_lanes 
-    global_last_note_time = -1000 
+    last_note_time = [-1000] * num_lanes
+    global_last_note_time = -1000
     lane_history = []
     rng = np.random.default_rng(NOTE_CONFIG['RNG_SEED'])
-    
-    start = 3 * buffer_size 
-    while start + buffer_size < len(audio_data):
-        current_ms = int((start / sr) * 1000)
-        chunk = audio_data[start : start + buffer_size]
-        spectrum = np.abs(scipy_rfft(chunk))
-        
-        lane_peaks = [0.0, 0.0, 0.0]
-        for i in range(len(spectrum)):
-            p = i / len(spectrum)
-            idx = 0 if p < lane_ranges[0] else 1 if p < lane_ranges[1] else 2
-            if spectrum[i] > lane_peaks[idx]:
-                lane_peaks[idx] = spectrum[i]
+
+    for current_ms, preferred in zip(onset_ms, preferred_lanes):
+        if (current_ms - global_last_note_time) <= NOTE_CONFIG['GLOBAL_COOLDOWN_MS']:
+            continue
+
+        fallback = [l for l in range(num_lanes) if l != preferred]
+        rng.shuffle(fallback)
 
         best_lane = -1
-        max_strength = 0
-
-        if (current_ms - global_last_note_time) > NOTE_CONFIG['GLOBAL_COOLDOWN_MS']:
-            check_order = [0, 1, 2]
-            rng.shuffle(check_order)
-
-            for l_idx in check_order:
-                strength = lane_peaks[l_idx] - current_thresholds[l_idx]
-                
-                if strength > 0 and strength > max_strength:
-                    if len(lane_history) >= NOTE_CONFIG['STREAK_LIMIT']:
-                        if all(x == l_idx for x in lane_history[-NOTE_CONFIG['STREAK_LIMIT']:]):
-                            continue 
-                    
-                    if (current_ms - last_note_time[l_idx]) > NOTE_CONFIG['MIN_NOTE_GAP_MS']:
-                        max_strength = strength
-                        best_lane = l_idx
+        for l_idx in [int(preferred)] + fallback:
+            if len(lane_history) >= NOTE_CONFIG['STREAK_LIMIT']:
+                if all(x == l_idx for x in lane_history[-NOTE_CONFIG['STREAK_LIMIT']:]):
+                    continue
+            if (current_ms - last_note_time[l_idx]) > NOTE_CONFIG['MIN_NOTE_GAP_MS']:
+                best_lane = l_idx
+                break
 
         if best_lane != -1:
             lane_indices.append(best_lane)
@@ -93,18 +677,100 @@ def create_auto_note_map(file_path):
             lane_history.append(best_lane)
             last_note_time[best_lane] = current_ms
             global_last_note_time = current_ms
-            
-            # Use UP_MOD to prevent double-hits
-            current_thresholds[best_lane] *= NOTE_CONFIG['UP_MOD']
 
-        # Recovery based on the auto-calculated base
-        for l_idx in range(num_lanes):
-            if current_thresholds[l_idx] > auto_thresholds[l_idx]:
-                current_thresholds[l_idx] -= (auto_thresholds[l_idx] * NOTE_CONFIG['RECOVERY_RATE'])
+    return lane_indices, timestamps_ms
+
+
+def _stft_magnitudes(audio_data, frame_size, hop_size, workers=1):
+    # Hann-windowed magnitude spectra of overlapping frames; frames must fit
+    # entirely inside the signal
+    if len(audio_data) < frame_size:
+        return np.zeros((0, frame_size // 2 + 1), dtype=np.float32)
+    frames = sliding_window_view(audio_data, frame_size)[::hop_size]
+    window = np.hanning(frame_size).astype(np.float32)
+    return _map_frame_ranges(lambda part: np.abs(scipy_rfft(part * window, axis=-1)),
+                             frames, workers)
+
+
+def _band_flux(spectra, lane_ranges=LANE_RANGES):
+    # Half-wave rectified frame-to-frame increase of the log-compressed
+    # magnitude, summed over each lane's bins. Row t is the flux into frame t.
+    log_mag = np.log1p(FLUX_CONFIG['LOG_COMPRESSION'] * spectra)
+    rise = np.maximum(np.diff(log_mag, axis=0, prepend=log_mag[:1]), 0.0)
+
+    bounds = _lane_bounds(spectra.shape[1], lane_ranges)
+    flux = np.zeros((len(spectra), len(lane_ranges)), dtype=np.float32)
+    for l_idx in range(len(lane_ranges)):
+        lo, hi = bounds[l_idx], bounds[l_idx + 1]
+        if hi > lo:
+            flux[:, l_idx] = rise[:, lo:hi].sum(axis=1)
+    return flux
+
+
+def _pick_peaks(flux):
+    # Frames where a lane's flux is the maximum of its neighbourhood and
+    # exceeds the local mean by DELTA times the lane's typical onset flux
+    # (its SCALE_PERCENTILE), so quiet lanes are judged on their own scale.
+    # Returns a boolean onset matrix and each onset's strength relative to
+    # its threshold. flux must have at least one row.
+    w = FLUX_CONFIG['PEAK_WINDOW']
+    m = FLUX_CONFIG['MEAN_WINDOW']
+    padded = np.pad(flux, ((max(w, m), max(w, m)), (0, 0)), mode='edge')
+    off = max(w, m)
+
+    local_max = sliding_window_view(padded, 2 * w + 1, axis=0).max(axis=-1)[off - w:off - w + len(flux)]
+    local_mean = sliding_window_view(padded, 2 * m + 1, axis=0).mean(axis=-1)[off - m:off - m + len(flux)]
+    scale = np.maximum(np.percentile(flux, FLUX_CONFIG['SCALE_PERCENTILE'], axis=0), 1e-6)
 
-        start += buffer_size
+    threshold = local_mean + FLUX_CONFIG['DELTA'] * scale
+    onsets = (flux >= local_max) & (flux > threshold)
+    return onsets, flux / threshold
+
+
+def create_flux_note_map_from_samples(audio_data, sr, workers=1, reference_rate=None):
+    """Map lanes from note onsets found by band-wise spectral flux.
+
+    An alternative to create_note_map_from_samples: a HOP_SIZE-spaced STFT
+    resolves fast passages that 2048-sample blocks merge, and thresholds
+    adapt to the local flux level, so there is no calibration pass. Each
+    onset frame is given to its strongest lane, then the usual cooldown, gap
+    and streak rules apply. Returns (lanes, timestamps_ms, onsets_ms), the
+    last being every detected onset before those rules. ``workers`` spreads
+    the STFT over that many threads; peak picking stays serial.
+    ``reference_rate`` is as in create_note_map_from_samples.
+    """
+    if reference_rate is not None:
+        check_analysis_rate(sr)
+    audio_data = np.asarray(audio_data, dtype=np.float32)
+    frame_size = _scaled_frames(FLUX_CONFIG['FRAME_SIZE'], sr, reference_rate)
+    hop_size = _scaled_frames(FLUX_CONFIG['HOP_SIZE'], sr, reference_rate)
+
+    spectra = _stft_magnitudes(audio_data, frame_size, hop_size, workers)
+    if not len(spectra):
+        # Shorter than one frame
+        return [], [], []
+    if frame_size != FLUX_CONFIG['FRAME_SIZE']:
+        spectra *= FLUX_CONFIG['FRAME_SIZE'] / frame_size
+    flux = _band_flux(spectra, _lane_ranges(sr, reference_rate))
+    onsets, strength = _pick_peaks(flux)
+
+    frames = np.flatnonzero(onsets.any(axis=1))
+    preferred = np.where(onsets[frames], strength[frames], -np.inf).argmax(axis=1)
+
+    # An onset in frame t happened within the part of the frame not covered
+    # by frame t-1, i.e. its last hop_size samples
+    onset_ms = ((frames * hop_size + frame_size - hop_size // 2) * 1000 // sr).tolist()
+    lanes, times = _place_onsets(onset_ms, preferred.tolist())
+    return lanes, times, onset_ms
+
+
+# Note map backends: each takes (mono samples, sample rate), and optionally
+# reference_rate, and returns (lanes, timestamps_ms, backend-specific info)
+NOTE_MAP_BACKENDS = {
+    'peaks': create_note_map_from_samples,
+    'flux': create_flux_note_map_from_samples,
+}
 
-    return lane_indices, timestamps_ms, auto_thresholds
 
 if __name__ == "__main__":
     lanes, times, final_thresh = create_auto_note_map("audio.mp3")
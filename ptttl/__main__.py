@@ -1,39 +1,271 @@
 import os
+import re
+import sys
+import glob
+import json
+import hashlib
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import ptttl
 from ptttl.parser import PTTTLParser
-from ptttl.audio import ptttl_to_wav
+from ptttl import audio
+from ptttl.audio import ptttl_to_wav, ptttl_data_to_wav, ptttl_data_to_mp3
 from tones import SINE_WAVE, SQUARE_WAVE, TRIANGLE_WAVE, SAWTOOTH_WAVE
 
 
+WAVE_TYPES = {
+    'sine': SINE_WAVE,
+    'square': SQUARE_WAVE,
+    'triangle': TRIANGLE_WAVE,
+    'sawtooth': SAWTOOTH_WAVE,
+}
+
+OUTPUT_FORMATS = ('wav', 'mp3', 'c')
+
+# Kept in the output directory; maps each output file to the hash of the
+# source text and options it was last generated from
+MANIFEST_NAME = '.ptttl-manifest.json'
+
+AMPLITUDE = 0.5
+
+
+def _expand_inputs(patterns):
+    # Globs are expanded here too, so quoted patterns work in CI scripts and
+    # on shells that don't expand them
+    paths = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(p for p in glob.glob(pattern, recursive=True)
+                             if os.path.isfile(p))
+            if not matches:
+                raise IOError("No files match '%s'" % pattern)
+            paths.extend(matches)
+        elif not os.path.exists(pattern):
+            raise IOError("File '%s' does not exist" % pattern)
+        else:
+            paths.append(pattern)
+
+    # Keep the first occurrence of each file
+    ret = []
+    seen = set()
+    for path in paths:
+        if os.path.abspath(path) not in seen:
+            seen.add(os.path.abspath(path))
+            ret.append(path)
+
+    return ret
+
+def _c_identifier(name):
+    ident = re.sub(r'\W', '_', name)
+    if not ident or ident[0].isdigit():
+        ident = '_' + ident
+    return ident
+
+def _c_array(ctype, name, values):
+    lines = []
+    for i in range(0, len(values), 12):
+        lines.append('    ' + ', '.join(str(v) for v in values[i:i + 12]) + ',')
+
+    return 'static const %s %s[%d] = {\n%s\n};\n' % (ctype, name, len(values), '\n'.join(lines))
+
+def ptttl_data_to_c(data, ident, source_name=''):
+    """
+    Format parsed song data as C source: per track, one array of note
+    frequencies in Hz (0 for rests) and one of note durations in milliseconds.
+
+    :param PTTTLData data: parsed song data
+    :param str ident: prefix for the generated C identifiers
+    :param str source_name: name of the source file, for the header comment
+    :return: C source text
+    :rtype: str
+    """
+    out = ['/* Generated by ptttl %s from %s */\n' % (ptttl.__version__, source_name),
+           '#include <stdint.h>\n\n',
+           '#define %s_NUM_TRACKS %d\n' % (ident.upper(), len(data.track_arrays))]
+
+    for i, track in enumerate(data.track_arrays):
+        freqs = [max(int(round(p)), 0) for p in track.pitch.tolist()]
+        millis = [int(round(d * 1000.0)) for d in track.duration.tolist()]
+        out.append('\n/* Track %d: %d notes */\n' % (i, len(track)))
+        out.append(_c_array('uint16_t', '%s_track%d_freq' % (ident, i), freqs))
+        out.append(_c_array('uint32_t', '%s_track%d_ms' % (ident, i), millis))
+
+    return ''.join(out)
+
+def _output_key(source, fmt, wave_type, engine):
+    payload = {
+        'source': hashlib.sha256(source).hexdigest(),
+        'format': fmt,
+        'version': ptttl.__version__,
+    }
+    if fmt != 'c':
+        payload.update({'wave_type': wave_type, 'engine': engine,
+                        'sample_rate': audio.SAMPLE_RATE, 'amplitude': AMPLITUDE})
+
+    blob = json.dumps(payload, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(blob).hexdigest()
+
+def _convert(source_path, outputs, wave_type, engine):
+    # Runs in a worker process when -j > 1, so settings are passed in
+    # rather than read from the parent's module state
+    audio.SYNTH_ENGINE = engine
+    wavetype = WAVE_TYPES[wave_type]
+
+    with open(source_path, 'r') as fh:
+        data = PTTTLParser().parse(fh.read())
+
+    for fmt, path in outputs:
+        if fmt == 'wav':
+            ptttl_data_to_wav(data, path, AMPLITUDE, wavetype)
+        elif fmt == 'mp3':
+            ptttl_data_to_mp3(data, path, AMPLITUDE, wavetype)
+        else:
+            stem = os.path.splitext(os.path.basename(source_path))[0]
+            with open(path, 'w') as fh:
+                fh.write(ptttl_data_to_c(data, _c_identifier(stem), os.path.basename(source_path)))
+
+def _load_manifest(path):
+    try:
+        with open(path, 'r') as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+def _save_manifest(path, manifest):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fh:
+        json.dump(manifest, fh, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def _run_batch(args):
+    inputs = _expand_inputs(args.filenames)
+    formats = args.formats or ['wav']
+    output_dir = args.output_dir or '.'
+    os.makedirs(output_dir, exist_ok=True)
+
+    stems = {}
+    for path in inputs:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        if stem in stems:
+            raise ValueError("'%s' and '%s' would write the same output files"
+                             % (stems[stem], path))
+        stems[stem] = path
+
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    manifest = {} if args.force else _load_manifest(manifest_path)
+
+    jobs = []
+    skipped = 0
+    for path in inputs:
+        with open(path, 'rb') as fh:
+            source = fh.read()
+
+        stem = os.path.splitext(os.path.basename(path))[0]
+        outputs = []
+        keys = {}
+        for fmt in formats:
+            out_path = os.path.join(output_dir, stem + '.' + ('h' if fmt == 'c' else fmt))
+            key = _output_key(source, fmt, args.wave_type, args.engine)
+            if manifest.get(os.path.basename(out_path)) == key and os.path.exists(out_path):
+                continue
+            outputs.append((fmt, out_path))
+            keys[os.path.basename(out_path)] = key
+
+        if outputs:
+            jobs.append((path, outputs, keys))
+        else:
+            skipped += 1
+            if not args.quiet:
+                print("skipped %s (unchanged)" % path, file=sys.stderr)
+
+    failed = 0
+    done = 0
+
+    def finished(path, keys, error):
+        nonlocal failed, done
+        done += 1
+        if error is None:
+            manifest.update(keys)
+            status = "ok"
+        else:
+            failed += 1
+            status = "FAILED: %s" % error
+        if not args.quiet or error is not None:
+            print("[%d/%d] %s %s" % (done, len(jobs), path, status), file=sys.stderr)
+
+    try:
+        if args.jobs > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(min(args.jobs, len(jobs))) as executor:
+                futures = {executor.submit(_convert, path, outputs, args.wave_type, args.engine):
+                           (path, keys) for path, outputs, keys in jobs}
+                for future in as_completed(futures):
+                    path, keys = futures[future]
+                    finished(path, keys, future.exception())
+        else:
+            for path, outputs, keys in jobs:
+                try:
+                    _convert(path, outputs, args.wave_type, args.engine)
+                    finished(path, keys, None)
+                except Exception as e:
+                    finished(path, keys, e)
+    finally:
+        _save_manifest(manifest_path, manifest)
+
+    print("%d converted, %d skipped, %d failed" % (len(jobs) - failed, skipped, failed),
+          file=sys.stderr)
+    return 1 if failed else 0
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-w', '--wave-type', default='sine', dest='wave_type',
-                        choices=['sine', 'square', 'triangle', 'sawtooth'],
+                        choices=sorted(WAVE_TYPES),
                         help="Set the type of waveform to be used")
-    parser.add_argument('-f', '--output-file', default='ptttl_audio.wav',
-                        dest='output_file', help="Filename for output audio file")
-    parser.add_argument('filename')
+    parser.add_argument('-e', '--engine', default=audio.SYNTH_ENGINE, dest='engine',
+                        choices=['numpy', 'tones'],
+                        help="Synthesizer used to render audio ('tones' is much slower)")
+    parser.add_argument('-f', '--output-file', default=None, dest='output_file',
+                        help="Filename for output audio file, when converting a single "
+                             "file to WAV (default: ptttl_audio.wav)")
+    parser.add_argument('-o', '--output-dir', default=None, dest='output_dir',
+                        help="Write <name>.wav/.mp3/.h for every input file into this "
+                             "directory, skipping outputs that are up to date")
+    parser.add_argument('-F', '--format', action='append', dest='formats',
+                        choices=OUTPUT_FORMATS,
+                        help="Output format for batch conversion, may be repeated "
+                             "(default: wav). 'c' writes note arrays as a C header")
+    parser.add_argument('-j', '--jobs', type=int, default=1, dest='jobs',
+                        help="Number of files to convert in parallel")
+    parser.add_argument('--force', action='store_true',
+                        help="Convert all files, even those that are up to date")
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help="Only report failures and the final summary")
+    parser.add_argument('filenames', nargs='+',
+                        help="PTTTL/RTTTL source files or glob patterns")
     args = parser.parse_args()
 
-    if not os.path.exists(args.filename):
-        raise IOError("File '%s' does not exist" % args.filename)
+    batch = args.output_dir is not None or args.formats or len(args.filenames) > 1 \
+        or glob.has_magic(args.filenames[0])
+    if not batch:
+        filename = args.filenames[0]
+        if not os.path.exists(filename):
+            raise IOError("File '%s' does not exist" % filename)
+
+        with open(filename, 'r') as fh:
+            ptttl_data = fh.read()
 
-    with open(args.filename, 'r') as fh:
-        ptttl_data = fh.read()
+        audio.SYNTH_ENGINE = args.engine
+        ptttl_to_wav(ptttl_data, args.output_file or 'ptttl_audio.wav', AMPLITUDE,
+                     WAVE_TYPES[args.wave_type])
+        return 0
 
-    wavetype = None
-    if args.wave_type == 'sine':
-        wavetype = SINE_WAVE
-    elif args.wave_type == 'square':
-        wavetype = SQUARE_WAVE
-    elif args.wave_type == 'triangle':
-        wavetype = TRIANGLE_WAVE
-    else:
-        wavetype = SAWTOOTH_WAVE
+    if args.output_file is not None:
+        parser.error("-f/--output-file only applies to a single input file; use -o")
+    if args.jobs < 1:
+        parser.error("-j/--jobs must be at least 1")
 
-    ptttl_to_wav(ptttl_data, args.output_file, 0.5, wavetype)
+    return _run_batch(args)
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
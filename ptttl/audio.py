@@ -1,44 +1,414 @@
 import sys
 import os
+import io
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
 import wave
+import asyncio
 import math
 import struct
 import subprocess
-import tempfile
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
 
 from ptttl.parser import PTTTLParser, PTTTLData
 
+import tones
 from tones.mixer import Mixer
-from tones import SINE_WAVE
+from tones import SINE_WAVE, SQUARE_WAVE, TRIANGLE_WAVE, SAWTOOTH_WAVE
 
 SAMPLE_RATE = 44100
 MP3_BITRATE = 128
 LAME_BIN = 'lame'
+# Upper bound on lame processes started concurrently by the *_async functions
+MAX_ENCODERS = os.cpu_count() or 1
+ENVELOPE_SECS = 0.01
+# Frames per block when audio is rendered and written as a stream
+STREAM_BLOCK_FRAMES = 64 * 1024
+# Byte budget of the rendered-note cache used by the numpy synth (see NoteCache)
+NOTE_CACHE_BYTES = 64 * 1024 * 1024
+# Default byte budget of each IncrementalRenderer's block cache
+BLOCK_CACHE_BYTES = 256 * 1024 * 1024
+
+# 'numpy' renders with the vectorized synth below, 'tones' falls back to
+# tones.Mixer (much slower, kept for comparison)
+SYNTH_ENGINE = 'numpy'
+
+# Same waveform shapes as tones, evaluated on a whole array of phases
+_WAVEFORMS = {
+    SINE_WAVE: np.sin,
+    SQUARE_WAVE: lambda ph: np.where(np.sin(ph) > 0, 1.0, -1.0),
+    TRIANGLE_WAVE: lambda ph: np.arcsin(np.sin(ph)),
+    SAWTOOTH_WAVE: lambda ph: np.arctan(np.tan(ph)),
+}
 
 
-def _wav_to_mp3(infile, outfile):
-    args = [LAME_BIN, '--silent', '-b', str(MP3_BITRATE), infile, outfile]
+def _lame_args(outfile):
+    # '-' makes lame read the WAV data from stdin
+    return [LAME_BIN, '--silent', '-b', str(MP3_BITRATE), '-', outfile]
 
+def _lame_failed(ret):
+    return OSError("Error (%d) returned by lame" % ret)
+
+def _lame_missing():
+    return OSError("Unable to run %s. Is %s installed?" % (LAME_BIN, LAME_BIN))
+
+def _wav_to_mp3(wavdata, outfile):
     try:
-        ret = subprocess.call(args)
-    except OSError as e:
-        os.remove(infile)
-        raise OSError("Unable to run %s. Is %s installed?"
-            % (LAME_BIN, LAME_BIN))
-
-    if ret != 0:
-        os.remove(infile)
-        raise OSError("Error (%d) returned by lame" % ret)
-
-def _generate_samples(parsed, amplitude, wavetype):
-    mixer = Mixer(SAMPLE_RATE, amplitude)
+        proc = subprocess.run(_lame_args(outfile), input=wavdata)
+    except OSError:
+        raise _lame_missing()
+
+    if proc.returncode != 0:
+        raise _lame_failed(proc.returncode)
+
+def _envelope(ramp_pos, length, rate):
+    # Linear fade matching tones' attack/decay: 0.0 at the note edge, rising
+    # by 1 / (rate * length) per sample until it reaches 1.0
+    return np.minimum(ramp_pos * (1.0 / (rate * length)), 1.0)
+
+def note_sample_counts(track, sample_rate=None):
+    """
+    Number of samples each note of a track occupies in the rendered audio.
+
+    :param PTTTLTrack track: one track of a PTTTLData object
+    :param int sample_rate: sample rate of the audio, SAMPLE_RATE if None
+    :return: per-note sample counts
+    :rtype: numpy.ndarray (int64)
+    """
+    rate = SAMPLE_RATE if sample_rate is None else sample_rate
+    return (track.duration * rate).astype(np.int64)
+
+def _synth(note_pitch, idx, note_count, note_vfreq, note_vvar, wavetype, rate):
+    # Per-sample synthesis: each argument has one entry per output sample,
+    # giving the note's pitch, the sample's position within its note, the
+    # note's length and its vibrato settings
+    t = idx / float(rate)
+    phase = 2.0 * math.pi * note_pitch * t
+
+    vib = note_vfreq > 0.0
+    if vib.any():
+        phase[vib] += (note_vvar[vib] / (2.0 * note_vfreq[vib])) * \
+            (1.0 - np.cos(2.0 * math.pi * note_vfreq[vib] * t[vib]))
+
+    out = _WAVEFORMS[wavetype](phase)
+    out *= _envelope(idx, ENVELOPE_SECS, rate)
+    out *= _envelope(note_count - 1 - idx, ENVELOPE_SECS, rate)
+    out[note_pitch <= 0.0] = 0.0
+
+    return out.astype(np.float32)
+
+def _render_notes(pitch, counts, vfreq, vvar, wavetype, rate):
+    """
+    Render consecutive notes, given as arrays, into one float32 buffer. Every
+    note's oscillator starts at phase 0 (as tones does); vibrato is added as
+    a sinusoidal frequency deviation of +/- variance/2, integrated
+    analytically into the phase.
+    """
+    total = int(counts.sum())
+    starts = np.cumsum(counts) - counts
+    idx = np.arange(total) - np.repeat(starts, counts)
+
+    return _synth(np.repeat(pitch, counts), idx, np.repeat(counts, counts),
+                  np.repeat(vfreq, counts), np.repeat(vvar, counts), wavetype, rate)
+
+def _track_notes(track, rate):
+    # Per-note synthesis parameters of a track, with the vibrato settings of
+    # notes that have none (and of rests) zeroed so equal notes compare equal
+    counts = note_sample_counts(track, rate)
+    vib = track.has_vibrato()
+    rest = track.pitch <= 0.0
+    return (np.where(rest, -1.0, track.pitch), counts,
+            np.where(vib & ~rest, track.vibrato_frequency, 0.0),
+            np.where(vib & ~rest, track.vibrato_variance, 0.0))
+
+def _render_track(track, wavetype, rate=None):
+    """
+    Render one track as a float32 buffer. Notes are rendered independently
+    of their position, so every distinct (pitch, length, vibrato) note is
+    synthesized once and repeats are copied into place; repeated phrases
+    therefore cost one gather instead of a re-synthesis.
+    """
+    if rate is None:
+        rate = SAMPLE_RATE
+    pitch, counts, vfreq, vvar = _track_notes(track, rate)
+    total = int(counts.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.float32)
+
+    keys = np.stack([pitch, counts.astype(np.float64), vfreq, vvar], axis=1)
+    uniq, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    ucounts = uniq[:, 1].astype(np.int64)
+    _record_dedupe(len(keys), len(uniq), total, int(ucounts.sum()))
+
+    if note_cache.max_bytes <= 0 and len(uniq) == len(keys):
+        return _render_notes(keys[:, 0], counts, keys[:, 2], keys[:, 3], wavetype, rate)
+
+    unique_samples = note_cache.render(uniq, wavetype, rate)
+    ustarts = np.cumsum(ucounts) - ucounts
+    starts = np.cumsum(counts) - counts
+    src = np.arange(total) + np.repeat(ustarts[inverse] - starts, counts)
+    return unique_samples[src]
+
+class NoteCache(object):
+    """
+    Bounded LRU cache of rendered note waveforms, shared by every song the
+    numpy synth renders. A note is keyed on its pitch, sample count, vibrato
+    settings and wave type, plus the sample rate and envelope length in
+    effect, so changing either module setting never returns stale audio.
+    Notes always start at phase 0 and carry their own attack/decay, so a
+    cached note is sample-identical to a freshly rendered one. Amplitude is
+    applied when tracks are mixed and is not part of the key.
+
+    :ivar int max_bytes: byte budget for cached samples; 0 disables the cache
+    :ivar int hits: notes served from the cache
+    :ivar int misses: notes that had to be rendered
+    :ivar int evictions: notes dropped to stay within max_bytes
+    """
+    def __init__(self, max_bytes):
+        """
+        :param int max_bytes: byte budget for cached samples
+        """
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._notes = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def render(self, notes, wavetype, rate=None):
+        """
+        Render notes back to back, reusing cached waveforms where possible.
+
+        :param numpy.ndarray notes: one (pitch, sample count, vibrato frequency,\
+            vibrato variance) row per note
+        :param int wavetype: Waveform type for output signal
+        :param int rate: sample rate to render at, SAMPLE_RATE if None
+        :return: concatenated note samples
+        :rtype: numpy.ndarray (float32)
+        """
+        if rate is None:
+            rate = SAMPLE_RATE
+        settings = (rate, ENVELOPE_SECS, wavetype)
+        keys = [settings + tuple(row) for row in notes.tolist()]
+        found = [None] * len(keys)
+
+        with self._lock:
+            for i, key in enumerate(keys):
+                cached = self._notes.get(key)
+                if cached is not None:
+                    self._notes.move_to_end(key)
+                    found[i] = cached
+            hits = sum(1 for f in found if f is not None)
+            self.hits += hits
+            self.misses += len(keys) - hits
+
+        missing = [i for i, f in enumerate(found) if f is None]
+        if missing:
+            rows = notes[missing]
+            counts = rows[:, 1].astype(np.int64)
+            rendered = _render_notes(rows[:, 0], counts, rows[:, 2], rows[:, 3], wavetype, rate)
+            for i, samples in zip(missing, np.split(rendered, np.cumsum(counts)[:-1])):
+                found[i] = samples
+            self._store([keys[i] for i in missing], [found[i] for i in missing])
+
+        if len(found) == 1:
+            return found[0]
+        return np.concatenate(found)
+
+    def _store(self, keys, rendered):
+        if self.max_bytes <= 0:
+            return
+
+        with self._lock:
+            for key, samples in zip(keys, rendered):
+                if samples.nbytes > self.max_bytes or key in self._notes:
+                    continue
+                # Stored notes are handed out as-is, so make sure nobody
+                # modifies them in place
+                samples = samples.copy()
+                samples.flags.writeable = False
+                self._notes[key] = samples
+                self._bytes += samples.nbytes
+
+            while self._bytes > self.max_bytes:
+                _, old = self._notes.popitem(last=False)
+                self._bytes -= old.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Drop every cached note. Counters are left as they are.
+        """
+        with self._lock:
+            self._notes.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        :return: entries, bytes, max_bytes, hits, misses and evictions
+        :rtype: dict
+        """
+        with self._lock:
+            return {'entries': len(self._notes), 'bytes': self._bytes,
+                    'max_bytes': self.max_bytes, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+# Shared by all renders in this process
+note_cache = NoteCache(NOTE_CACHE_BYTES)
+
+_dedupe_lock = threading.Lock()
+_dedupe_totals = {'notes': 0, 'unique_notes': 0, 'samples': 0, 'unique_samples': 0}
+
+def _record_dedupe(notes, unique_notes, samples, unique_samples):
+    with _dedupe_lock:
+        _dedupe_totals['notes'] += notes
+        _dedupe_totals['unique_notes'] += unique_notes
+        _dedupe_totals['samples'] += samples
+        _dedupe_totals['unique_samples'] += unique_samples
+
+def dedupe_stats(reset=False):
+    """
+    Totals of notes and samples passed through the numpy synth since the
+    last reset, and how many of them had to be synthesized. 'ratio' is the
+    share of samples that were copies of an already rendered note.
+
+    :param bool reset: zero the counters after reading them
+    :rtype: dict
+    """
+    with _dedupe_lock:
+        ret = dict(_dedupe_totals)
+        if reset:
+            for key in _dedupe_totals:
+                _dedupe_totals[key] = 0
+
+    samples = ret['samples']
+    ret['ratio'] = (1.0 - float(ret['unique_samples']) / samples) if samples else 0.0
+    return ret
+
+def _generate_samples_numpy(parsed, amplitude, wavetype, workers=None, pool='thread', rate=None):
+    if wavetype not in _WAVEFORMS:
+        raise ValueError("Invalid wave type: %s" % wavetype)
+
+    if rate is None:
+        rate = SAMPLE_RATE
+    tracks = parsed.track_arrays
+    if not workers or workers <= 1 or len(tracks) <= 1:
+        rendered = [_render_track(track, wavetype, rate) for track in tracks]
+    elif pool == 'thread':
+        rendered = _render_tracks_threaded(tracks, wavetype, workers, rate)
+    elif pool == 'process':
+        return _render_tracks_shared(tracks, amplitude, wavetype, workers, rate)
+    else:
+        raise ValueError("Invalid pool type: %s" % pool)
+
+    return _mix_tracks(rendered, amplitude)
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+def _get_executor(pool, workers):
+    # Pools are kept for the life of the process; starting worker processes
+    # costs far more than rendering a short song
+    with _executors_lock:
+        executor = _executors.get((pool, workers))
+        if executor is None:
+            if pool == 'thread':
+                executor = ThreadPoolExecutor(workers)
+            else:
+                executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+            _executors[(pool, workers)] = executor
+        return executor
+
+def _render_tracks_threaded(tracks, wavetype, workers, rate):
+    # The heavy numpy calls release the GIL, so tracks render concurrently
+    executor = _get_executor('thread', workers)
+    return list(executor.map(_render_track, tracks, [wavetype] * len(tracks),
+                             [rate] * len(tracks)))
+
+def _render_track_into(shm_name, shape, row, track, wavetype, settings):
+    # Runs in a worker process: render one track straight into its row of
+    # the caller's shared buffer, so only note arrays cross the pipe
+    global ENVELOPE_SECS
+    rate, ENVELOPE_SECS = settings
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        samples = _render_track(track, wavetype, rate)
+        buf = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        try:
+            buf[row, :len(samples)] = samples
+        finally:
+            del buf
+    finally:
+        _close_shared(shm)
+
+def _render_tracks_shared(tracks, amplitude, wavetype, workers, rate):
+    lengths = [int(note_sample_counts(track, rate).sum()) for track in tracks]
+    shape = (len(tracks), max(max(lengths), 1))
+    nbytes = shape[0] * shape[1] * np.dtype(np.float32).itemsize
+
+    executor = _get_executor('process', workers)
+    shm = shared_memory.SharedMemory(create=True, size=nbytes)
+    try:
+        settings = (rate, ENVELOPE_SECS)
+        futures = [executor.submit(_render_track_into, shm.name, shape, row, track,
+                                   wavetype, settings)
+                   for row, track in enumerate(tracks)]
+        for future in futures:
+            future.result()
+
+        buf = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        try:
+            mixed = _mix_tracks([buf[row, :lengths[row]] for row in range(len(tracks))],
+                                amplitude)
+        finally:
+            del buf
+    finally:
+        _close_shared(shm)
+        shm.unlink()
+
+    return mixed
+
+def _close_shared(shm):
+    # Views into the buffer can outlive a failed render in the exception's
+    # traceback; close() would then raise BufferError and hide the original
+    # error. The mapping is released with the last view instead.
+    try:
+        shm.close()
+    except BufferError:
+        pass
+
+def _mix_tracks(rendered, amplitude):
+    if not rendered:
+        return np.zeros(0, dtype=np.float32)
+
+    mixed = np.zeros(max(len(r) for r in rendered), dtype=np.float32)
+    for r in rendered:
+        mixed[:len(r)] += r
+
+    mixed *= amplitude / len(rendered)
+    return mixed
+
+def _generate_samples_tones(parsed, amplitude, wavetype, rate=None):
+    mixer = Mixer(SAMPLE_RATE if rate is None else rate, amplitude)
     numchannels = 0
 
-    for i in range(len(parsed.tracks)):
-        mixer.create_track(i, wavetype=wavetype, attack=0.01, decay=0.01)
+    tracks = parsed.tracks
+
+    for i in range(len(tracks)):
+        mixer.create_track(i, wavetype=wavetype, attack=ENVELOPE_SECS, decay=ENVELOPE_SECS)
 
-    for i in range(len(parsed.tracks)):
-        for note in parsed.tracks[i]:
+    for i in range(len(tracks)):
+        for note in tracks[i]:
             if note.pitch <= 0.0:
                 mixer.add_silence(i, duration=note.duration)
             else:
@@ -46,28 +416,213 @@ def _generate_samples(parsed, amplitude, wavetype):
                                vibrato_frequency=note.vibrato_frequency,
                                vibrato_variance=note.vibrato_variance)
 
-    return mixer.mix()
+    return np.array(mixer.mix(), dtype=np.float32)
+
+def _generate_samples(parsed, amplitude, wavetype, workers=None, pool='thread', rate=None):
+    if SYNTH_ENGINE == 'tones':
+        return _generate_samples_tones(parsed, amplitude, wavetype, rate)
+    if SYNTH_ENGINE != 'numpy':
+        raise ValueError("Invalid synth engine: %s" % SYNTH_ENGINE)
+
+    return _generate_samples_numpy(parsed, amplitude, wavetype, workers, pool, rate)
+
+def _serialize(samples):
+    # Same conversion as tones.tone.Samples.serialize: scale, truncate
+    # towards zero and clip to +/-MAX_SAMPLE_VALUE
+    maxval = tones.MAX_SAMPLE_VALUE
+    scaled = np.clip(samples.astype(np.float64) * maxval, -maxval, maxval)
+    return scaled.astype('<i2').tobytes()
+
+def _wav_bytes(sampledata):
+    # WAV container around already serialized 16-bit mono PCM, built in memory
+    buf = io.BytesIO()
+    f = wave.open(buf, 'wb')
+    f.setparams((tones.NUM_CHANNELS, tones.DATA_SIZE, SAMPLE_RATE,
+        int(len(sampledata) / 2), "NONE", "Uncompressed"))
+    f.writeframes(sampledata)
+    f.close()
+    return buf.getvalue()
+
+def _song_frames(parsed):
+    return max([int(note_sample_counts(t).sum()) for t in parsed.track_arrays] or [0])
+
+def _stream_blocks(parsed, amplitude, wavetype, block_frames):
+    # Mix all tracks block by block, synthesizing only the samples of each
+    # block; memory use depends on block_frames, not on the song length
+    if SYNTH_ENGINE != 'numpy':
+        sampledata = _serialize(_generate_samples(parsed, amplitude, wavetype))
+        blocksize = block_frames * tones.DATA_SIZE
+        for i in range(0, len(sampledata), blocksize):
+            yield sampledata[i:i + blocksize]
+        return
+
+    if wavetype not in _WAVEFORMS:
+        raise ValueError("Invalid wave type: %s" % wavetype)
+
+    tracks = []
+    for track in parsed.track_arrays:
+        pitch, counts, vfreq, vvar = _track_notes(track, SAMPLE_RATE)
+        keys = np.stack([pitch, counts.astype(np.float64), vfreq, vvar], axis=1)
+        ends = np.cumsum(counts)
+        tracks.append((keys, ends, ends - counts))
+
+        # Counted per track, as _render_track does, so dedupe_stats() reads
+        # the same whether a song was streamed or rendered in one piece
+        uniq = np.unique(keys, axis=0)
+        _record_dedupe(len(keys), len(uniq), int(counts.sum()), int(uniq[:, 1].sum()))
+
+    nframes = _song_frames(parsed)
+    for start in range(0, nframes, block_frames):
+        end = min(start + block_frames, nframes)
+        mixed = np.zeros(end - start, dtype=np.float32)
+
+        for keys, ends, starts in tracks:
+            track_end = min(end, int(ends[-1]) if len(ends) else 0)
+            if track_end <= start:
+                continue
+
+            # Render the notes overlapping this block whole (through the
+            # note cache, like _render_track) and copy out the part we need
+            first = np.searchsorted(ends, start, side='right')
+            last = np.searchsorted(starts, track_end, side='left')
+            uniq, inverse = np.unique(keys[first:last], axis=0, return_inverse=True)
+            ucounts = uniq[:, 1].astype(np.int64)
+            unique_samples = note_cache.render(uniq, wavetype)
+
+            lens = np.minimum(ends[first:last], track_end) - np.maximum(starts[first:last], start)
+            offsets = (np.cumsum(ucounts) - ucounts)[inverse.reshape(-1)] - starts[first:last]
+            src = np.arange(start, track_end) + np.repeat(offsets, lens)
+            mixed[:track_end - start] += unique_samples[src]
+
+        mixed *= amplitude / len(tracks)
+        yield _serialize(mixed)
+
+def _wav_header(nframes):
+    # Canonical 44-byte header for 16-bit mono PCM, as written by the wave module
+    blockalign = tones.NUM_CHANNELS * tones.DATA_SIZE
+    datasize = nframes * blockalign
+    return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + datasize, b'WAVE',
+                       b'fmt ', 16, 1, tones.NUM_CHANNELS, SAMPLE_RATE,
+                       SAMPLE_RATE * blockalign, blockalign, 8 * tones.DATA_SIZE,
+                       b'data', datasize)
+
+def _partial_path(filename):
+    # Streamed output is written next to its destination and renamed into
+    # place once complete, so a render that fails part way never leaves a
+    # truncated file behind (or clobbers a previous good one)
+    return "%s.%d-%d.part" % (filename, os.getpid(), threading.get_ident())
+
+def _discard(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def _write_wav_blocks(filename, nframes, blocks):
+    # The frame count is known up front, so the header is written once and
+    # never patched
+    partial = _partial_path(filename)
+    try:
+        f = wave.open(partial, 'wb')
+        try:
+            f.setparams((tones.NUM_CHANNELS, tones.DATA_SIZE, SAMPLE_RATE, nframes,
+                         "NONE", "Uncompressed"))
+            for block in blocks:
+                f.writeframesraw(block)
+        finally:
+            f.close()
+        os.replace(partial, filename)
+    except BaseException:
+        _discard(partial)
+        raise
+
+def _wav_blocks_to_mp3(nframes, blocks, outfile):
+    partial = _partial_path(outfile)
+    try:
+        proc = subprocess.Popen(_lame_args(partial), stdin=subprocess.PIPE)
+    except OSError:
+        raise _lame_missing()
+
+    try:
+        try:
+            proc.stdin.write(_wav_header(nframes))
+            for block in blocks:
+                proc.stdin.write(block)
+        except BrokenPipeError:
+            pass
+        except BaseException:
+            # Rendering failed; don't let lame finish encoding a short song
+            proc.kill()
+            raise
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            ret = proc.wait()
+
+        if ret != 0:
+            raise _lame_failed(ret)
+        os.replace(partial, outfile)
+    except BaseException:
+        _discard(partial)
+        raise
+
+def _generate_wav_file(parsed, amplitude, wavetype, filename, workers=None, pool='thread'):
+    if SYNTH_ENGINE == 'numpy' and not (workers and workers > 1):
+        _write_wav_blocks(filename, _song_frames(parsed),
+                          _stream_blocks(parsed, amplitude, wavetype, STREAM_BLOCK_FRAMES))
+        return
 
-def _generate_wav_file(parsed, amplitude, wavetype, filename):
-    sampledata = _generate_samples(parsed, amplitude, wavetype).serialize()
-    Mixer(SAMPLE_RATE, amplitude).write_wav(filename, sampledata)
+    # Parallel rendering works on whole tracks (and tones renders whole
+    # songs), so the audio is rendered in full and written as one block
+    sampledata = _serialize(_generate_samples(parsed, amplitude, wavetype, workers, pool))
+    _write_wav_blocks(filename, len(sampledata) // tones.DATA_SIZE, [sampledata])
 
-def ptttl_to_samples(ptttl_data, amplitude=0.5, wavetype=SINE_WAVE):
+def ptttl_to_samples(ptttl_data, amplitude=0.5, wavetype=SINE_WAVE, workers=None,
+                     pool='thread', sample_rate=None):
     """
-    Convert a PTTTLData object to a list of audio samples.
+    Convert a PTTTLData object to an array of audio samples.
 
     :param PTTTLData ptttl_data: PTTTL/RTTTL source text
     :param float amplitude: Output signal amplitude, between 0.0 and 1.0.
     :param int wavetype: Waveform type for output signal. Must be one of\
         tones.SINE_WAVE, tones.SQUARE_WAVE, tones.TRIANGLE_WAVE, or tones.SAWTOOTH_WAVE.
-    :return: list of audio samples
-    :rtype: tones.tone.Samples
+    :param int workers: Number of tracks to render concurrently; None or 1\
+        renders them one after another. Only used by the numpy synth.
+    :param str pool: 'thread' to render in a thread pool, or 'process' to\
+        render in worker processes that write into a shared-memory buffer.
+    :param int sample_rate: Sample rate to render at, SAMPLE_RATE if None. A\
+        lower rate is enough (and much cheaper) for coarse analysis.
+    :return: audio samples in the range -1.0 to 1.0
+    :rtype: numpy.ndarray (float32)
     """
     parser = PTTTLParser()
     data = parser.parse(ptttl_data)
-    return _generate_samples(data, amplitude, wavetype)
+    return _generate_samples(data, amplitude, wavetype, workers, pool, sample_rate)
+
+def ptttl_data_to_samples(data, amplitude=0.5, wavetype=SINE_WAVE, workers=None,
+                          pool='thread', sample_rate=None):
+    """
+    Same as ptttl_to_samples, but for song data that has already been parsed.
+
+    :param PTTTLData data: parsed song data
+    :param float amplitude: Output signal amplitude, between 0.0 and 1.0.
+    :param int wavetype: Waveform type for output signal. Must be one of\
+        tones.SINE_WAVE, tones.SQUARE_WAVE, tones.TRIANGLE_WAVE, or tones.SAWTOOTH_WAVE.
+    :param int workers: Number of tracks to render concurrently; None or 1\
+        renders them one after another. Only used by the numpy synth.
+    :param str pool: 'thread' to render in a thread pool, or 'process' to\
+        render in worker processes that write into a shared-memory buffer.
+    :param int sample_rate: Sample rate to render at, SAMPLE_RATE if None. A\
+        lower rate is enough (and much cheaper) for coarse analysis.
+    :return: audio samples in the range -1.0 to 1.0
+    :rtype: numpy.ndarray (float32)
+    """
+    return _generate_samples(data, amplitude, wavetype, workers, pool, sample_rate)
 
-def ptttl_to_wav_samples(ptttl_data, amplitude=0.5, wavetype=SINE_WAVE):
+def ptttl_to_wav_samples(ptttl_data, amplitude=0.5, wavetype=SINE_WAVE, workers=None,
+                         pool='thread'):
     """
     Convert a PTTTLData object to a list of audio samples, packed into string
     and ready for writing to .wav files.
@@ -76,12 +631,17 @@ def ptttl_to_wav_samples(ptttl_data, amplitude=0.5, wavetype=SINE_WAVE):
     :param float amplitude: Output signal amplitude, between 0.0 and 1.0.
     :param int wavetype: Waveform type for output signal. Must be one of\
         tones.SINE_WAVE, tones.SQUARE_WAVE, tones.TRIANGLE_WAVE, or tones.SAWTOOTH_WAVE.
+    :param int workers: Number of tracks to render concurrently; None or 1\
+        renders them one after another. Only used by the numpy synth.
+    :param str pool: 'thread' to render in a thread pool, or 'process' to\
+        render in worker processes that write into a shared-memory buffer.
     :return: list of audio samples
     :rtype: str
     """
-    return ptttl_to_samples(data, amplitude, wavetype).serialize()
+    return _serialize(ptttl_to_samples(ptttl_data, amplitude, wavetype, workers, pool))
 
-def ptttl_to_wav(ptttl_data, wav_filename, amplitude=0.5, wavetype=SINE_WAVE):
+def ptttl_to_wav(ptttl_data, wav_filename, amplitude=0.5, wavetype=SINE_WAVE, workers=None,
+                 pool='thread'):
     """
     Convert a PTTTLData object to audio data and write it to a .wav file.
 
@@ -90,10 +650,41 @@ def ptttl_to_wav(ptttl_data, wav_filename, amplitude=0.5, wavetype=SINE_WAVE):
     :param float amplitude: Output signal amplitude, between 0.0 and 1.0.
     :param int wavetype: Waveform type for output signal. Must be one of\
         tones.SINE_WAVE, tones.SQUARE_WAVE, tones.TRIANGLE_WAVE, or tones.SAWTOOTH_WAVE.
+    :param int workers: Number of tracks to render concurrently; None or 1\
+        renders them one after another. Only used by the numpy synth.
+    :param str pool: 'thread' to render in a thread pool, or 'process' to\
+        render in worker processes that write into a shared-memory buffer.
     """
-    parser = PTTTLParser()
-    data = parser.parse(ptttl_data)
-    samples = _generate_wav_file(data, amplitude, wavetype, wav_filename)
+    ptttl_data_to_wav(PTTTLParser().parse(ptttl_data), wav_filename, amplitude, wavetype,
+                      workers, pool)
+
+def ptttl_data_to_wav(data, wav_filename, amplitude=0.5, wavetype=SINE_WAVE, workers=None,
+                      pool='thread'):
+    """
+    Same as ptttl_to_wav, but for song data that has already been parsed.
+
+    :param PTTTLData data: parsed song data
+    :param str wav_filename: Filename for output .wav file
+    :param float amplitude: Output signal amplitude, between 0.0 and 1.0.
+    :param int wavetype: Waveform type for output signal. Must be one of\
+        tones.SINE_WAVE, tones.SQUARE_WAVE, tones.TRIANGLE_WAVE, or tones.SAWTOOTH_WAVE.
+    :param int workers: Number of tracks to render concurrently; None or 1\
+        renders them one after another. Only used by the numpy synth.
+    :param str pool: 'thread' to render in a thread pool, or 'process' to\
+        render in worker processes that write into a shared-memory buffer.
+    """
+    _generate_wav_file(data, amplitude, wavetype, wav_filename, workers, pool)
+
+def samples_to_mp3(samples, mp3_filename):
+    """
+    Write audio samples, as returned by ptttl_to_samples, to an .mp3 file (requires
+    the LAME audio mp3 encoder to be installed and in your system path). The WAV
+    data is piped to lame, so no temporary file is written.
+
+    :param numpy.ndarray samples: audio samples to encode
+    :param str mp3_filename: Filename for output .mp3 file
+    """
+    _wav_to_mp3(_wav_bytes(_serialize(samples)), mp3_filename)
 
 def ptttl_to_mp3(ptttl_data, mp3_filename, amplitude=0.5, wavetype=SINE_WAVE):
     """
@@ -106,8 +697,249 @@ def ptttl_to_mp3(ptttl_data, mp3_filename, amplitude=0.5, wavetype=SINE_WAVE):
     :param int wavetype: Waveform type for output signal. Must be one of\
         tones.SINE_WAVE, tones.SQUARE_WAVE, tones.TRIANGLE_WAVE, or tones.SAWTOOTH_WAVE.
     """
-    fd, wavfile = tempfile.mkstemp()
-    ptttl_to_wav(ptttl_data, wavfile, amplitude, wavetype)
-    _wav_to_mp3(wavfile, mp3_filename)
-    os.close(fd)
-    os.remove(wavfile)
+    ptttl_data_to_mp3(PTTTLParser().parse(ptttl_data), mp3_filename, amplitude, wavetype)
+
+def ptttl_data_to_mp3(data, mp3_filename, amplitude=0.5, wavetype=SINE_WAVE):
+    """
+    Same as ptttl_to_mp3, but for song data that has already been parsed.
+
+    :param PTTTLData data: parsed song data
+    :param str mp3_filename: Filename for output .mp3 file
+    :param float amplitude: Output signal amplitude, between 0.0 and 1.0.
+    :param int wavetype: Waveform type for output signal. Must be one of\
+        tones.SINE_WAVE, tones.SQUARE_WAVE, tones.TRIANGLE_WAVE, or tones.SAWTOOTH_WAVE.
+    """
+    if SYNTH_ENGINE != 'numpy':
+        samples_to_mp3(_generate_samples(data, amplitude, wavetype), mp3_filename)
+        return
+
+    _wav_blocks_to_mp3(_song_frames(data),
+                       _stream_blocks(data, amplitude, wavetype, STREAM_BLOCK_FRAMES),
+                       mp3_filename)
+
+def ptttl_data_to_wav_blocks(data, amplitude=0.5, wavetype=SINE_WAVE,
+                             block_frames=STREAM_BLOCK_FRAMES):
+    """
+    Render song data that has already been parsed as a stream of 16-bit mono
+    PCM blocks, mixed across all tracks and in time order. Only one block of
+    audio is held in memory at a time. Joined together, the blocks equal the
+    data portion of the .wav file written by ptttl_to_wav; prefix them with
+    wav_header(data) to pipe a complete .wav file into an encoder.
+
+    :param PTTTLData data: parsed song data
+    :param float amplitude: Output signal amplitude, between 0.0 and 1.0.
+    :param int wavetype: Waveform type for output signal. Must be one of\
+        tones.SINE_WAVE, tones.SQUARE_WAVE, tones.TRIANGLE_WAVE, or tones.SAWTOOTH_WAVE.
+    :param int block_frames: Number of frames per block (the last block may be shorter)
+    :return: generator of little-endian int16 sample blocks
+    :rtype: generator of bytes
+    """
+    return _stream_blocks(data, amplitude, wavetype, block_frames)
+
+def ptttl_to_wav_blocks(ptttl_data, amplitude=0.5, wavetype=SINE_WAVE,
+                        block_frames=STREAM_BLOCK_FRAMES):
+    """
+    Same as ptttl_data_to_wav_blocks, but takes PTTTL/RTTTL source text.
+
+    :param str ptttl_data: PTTTL/RTTTL source text
+    :param float amplitude: Output signal amplitude, between 0.0 and 1.0.
+    :param int wavetype: Waveform type for output signal. Must be one of\
+        tones.SINE_WAVE, tones.SQUARE_WAVE, tones.TRIANGLE_WAVE, or tones.SAWTOOTH_WAVE.
+    :param int block_frames: Number of frames per block (the last block may be shorter)
+    :return: generator of little-endian int16 sample blocks
+    :rtype: generator of bytes
+    """
+    parser = PTTTLParser()
+    data = parser.parse(ptttl_data)
+    return _stream_blocks(data, amplitude, wavetype, block_frames)
+
+def wav_header(data):
+    """
+    .wav file header for the audio of a parsed song, to be followed by the
+    blocks from ptttl_data_to_wav_blocks.
+
+    :param PTTTLData data: parsed song data
+    :return: 44-byte RIFF/WAVE header
+    :rtype: bytes
+    """
+    return _wav_header(_song_frames(data))
+
+# One semaphore per event loop: an asyncio.Semaphore binds to the first loop
+# that waits on it, so sharing one breaks the next asyncio.run()
+_encoder_slots = weakref.WeakKeyDictionary()
+_encoder_slots_lock = threading.Lock()
+
+def _get_encoder_slots():
+    loop = asyncio.get_running_loop()
+    with _encoder_slots_lock:
+        slots = _encoder_slots.get(loop)
+        if slots is None:
+            slots = asyncio.Semaphore(MAX_ENCODERS)
+            _encoder_slots[loop] = slots
+        return slots
+
+async def samples_to_mp3_async(samples, mp3_filename):
+    """
+    Asyncio version of samples_to_mp3. At most MAX_ENCODERS lame processes run
+    at once; further calls wait for a free slot. If the calling task is
+    cancelled, lame is killed before the cancellation propagates.
+
+    :param numpy.ndarray samples: audio samples to encode
+    :param str mp3_filename: Filename for output .mp3 file
+    """
+    wavdata = _wav_bytes(_serialize(samples))
+
+    async with _get_encoder_slots():
+        # lame is started with Popen and fed from the default executor rather
+        # than through asyncio's subprocess transport: on Python 3.11 a
+        # transport cancelled while still connecting its pipes never finishes,
+        # which hangs asyncio.run() on shutdown
+        try:
+            proc = subprocess.Popen(_lame_args(mp3_filename), stdin=subprocess.PIPE)
+        except OSError:
+            raise _lame_missing()
+
+        feed = asyncio.get_running_loop().run_in_executor(None, proc.communicate, wavdata)
+        try:
+            await asyncio.shield(feed)
+        except asyncio.CancelledError:
+            # Don't leave lame running (and the slot held) behind us
+            proc.kill()
+            await feed
+            raise
+
+    if proc.returncode != 0:
+        raise _lame_failed(proc.returncode)
+
+async def ptttl_to_mp3_async(ptttl_data, mp3_filename, amplitude=0.5, wavetype=SINE_WAVE):
+    """
+    Asyncio version of ptttl_to_mp3. Synthesis runs in the event loop's default
+    executor and encoding goes through samples_to_mp3_async.
+
+    :param str ptttl_data: PTTTL/RTTTL source text
+    :param str mp3_filename: Filename for output .mp3 file
+    :param float amplitude: Output signal amplitude, between 0.0 and 1.0.
+    :param int wavetype: Waveform type for output signal. Must be one of\
+        tones.SINE_WAVE, tones.SQUARE_WAVE, tones.TRIANGLE_WAVE, or tones.SAWTOOTH_WAVE.
+    """
+    loop = asyncio.get_running_loop()
+    samples = await loop.run_in_executor(None, ptttl_to_samples, ptttl_data,
+                                         amplitude, wavetype)
+    await samples_to_mp3_async(samples, mp3_filename)
+
+def _block_nbytes(cached):
+    tracks, rendered = cached
+    return (sum(t.pitch.nbytes + t.duration.nbytes + t.vibrato_frequency.nbytes +
+                t.vibrato_variance.nbytes for t in tracks) +
+            sum(r.nbytes for r in rendered))
+
+class IncrementalRenderer(object):
+    """
+    Re-renders edited PTTTL scores by redoing only the ';'-separated blocks
+    whose text changed. Each block's parsed tracks and rendered per-track
+    samples are cached under a hash of the block text and song settings;
+    render() splices the cached audio back together at each block's sample
+    offset, giving exactly the same samples as ptttl_to_samples.
+
+    :ivar int blocks_rendered: blocks parsed and synthesized so far
+    :ivar int blocks_reused: blocks taken from the cache so far
+    :ivar int blocks_evicted: blocks dropped to stay within the cache limits
+    """
+    def __init__(self, amplitude=0.5, wavetype=SINE_WAVE, max_blocks=4096,
+                 max_bytes=BLOCK_CACHE_BYTES):
+        """
+        :param float amplitude: Output signal amplitude, between 0.0 and 1.0.
+        :param int wavetype: Waveform type for output signal. Must be one of\
+            tones.SINE_WAVE, tones.SQUARE_WAVE, tones.TRIANGLE_WAVE, or tones.SAWTOOTH_WAVE.
+        :param int max_blocks: Maximum number of blocks kept in the cache
+        :param int max_bytes: Byte budget for the cached note arrays and samples;\
+            least recently used blocks are evicted beyond it
+        """
+        self.amplitude = amplitude
+        self.wavetype = wavetype
+        self.max_blocks = max_blocks
+        self.max_bytes = max_bytes
+        self.blocks_rendered = 0
+        self.blocks_reused = 0
+        self.blocks_evicted = 0
+        self._parser = PTTTLParser()
+        self._blocks = OrderedDict()
+        self._bytes = 0
+
+    def _block(self, block, settings):
+        key = hashlib.sha1(repr((settings, SAMPLE_RATE, self.wavetype, block))
+                           .encode('utf-8')).hexdigest()
+
+        cached = self._blocks.get(key)
+        if cached is not None:
+            self._blocks.move_to_end(key)
+            self.blocks_reused += 1
+            return cached
+
+        tracks = self._parser.parse_block(block, settings)
+        cached = (tracks, [_render_track(t, self.wavetype) for t in tracks])
+        self.blocks_rendered += 1
+
+        nbytes = _block_nbytes(cached)
+        if nbytes > self.max_bytes:
+            # Too big to ever fit; use it once without caching
+            return cached
+
+        self._blocks[key] = cached
+        self._bytes += nbytes
+        while len(self._blocks) > self.max_blocks or self._bytes > self.max_bytes:
+            _, old = self._blocks.popitem(last=False)
+            self._bytes -= _block_nbytes(old)
+            self.blocks_evicted += 1
+
+        return cached
+
+    def render(self, ptttl_data):
+        """
+        Convert PTTTL/RTTTL source text to audio samples, reusing cached blocks.
+
+        :param str ptttl_data: PTTTL/RTTTL source text
+        :return: audio samples in the range -1.0 to 1.0
+        :rtype: numpy.ndarray (float32)
+        """
+        if SYNTH_ENGINE != 'numpy':
+            return ptttl_to_samples(ptttl_data, self.amplitude, self.wavetype)
+        if self.wavetype not in _WAVEFORMS:
+            raise ValueError("Invalid wave type: %s" % self.wavetype)
+
+        name, settings, blocks = self._parser.split_blocks(ptttl_data)
+        parts = [self._block(block, settings) for block in blocks]
+
+        numtracks = len(parts[0][0])
+        if any(len(p[0]) != numtracks for p in parts):
+            # Malformed across blocks; the full parser reports the error
+            return ptttl_to_samples(ptttl_data, self.amplitude, self.wavetype)
+
+        empty = [any(len(p[0][j]) == 0 for p in parts) for j in range(numtracks)]
+        if any(empty) and len(parts) > 1:
+            return ptttl_to_samples(ptttl_data, self.amplitude, self.wavetype)
+
+        rendered = []
+        for j in range(numtracks):
+            if empty[j]:
+                # parse() drops a track with no notes at all
+                continue
+
+            track = np.zeros(sum(len(p[1][j]) for p in parts), dtype=np.float32)
+            offset = 0
+            for p in parts:
+                samples = p[1][j]
+                track[offset:offset + len(samples)] = samples
+                offset += len(samples)
+            rendered.append(track)
+
+        return _mix_tracks(rendered, self.amplitude)
+
+    def render_wav(self, ptttl_data, wav_filename):
+        """
+        Same as render, but writes the result to a .wav file.
+
+        :param str ptttl_data: PTTTL/RTTTL source text
+        :param str wav_filename: Filename for output .wav file
+        """
+        Mixer(SAMPLE_RATE, self.amplitude).write_wav(wav_filename, _serialize(self.render(ptttl_data)))
@@ -1,6 +1,9 @@
 import math
+import re
 import sys
 
+import numpy as np
+
 NOTES = {
     "c": 261.625565301,
     "c#": 277.182630977,
@@ -23,6 +26,27 @@ NOTES = {
 }
 
 
+# Pitch of every note name in every valid octave (0-8), computed exactly as
+# the per-note scaling used to be
+PITCHES = {}
+for _name, _raw in NOTES.items():
+    for _octave in range(9):
+        if _octave < 4:
+            PITCHES[(_name, _octave)] = _raw / math.pow(2, (4 - _octave))
+        elif _octave > 4:
+            PITCHES[(_name, _octave)] = _raw * math.pow(2, (_octave - 4))
+        else:
+            PITCHES[(_name, _octave)] = _raw
+
+# One note: optional duration digits, note letters (and '#'), an optional
+# dot, then anything else (octave digits and/or a trailing dot)
+_NOTE_RE = re.compile(r'(\d*)((?:[^\W\d_]|#)*)(\.?)(.*)', re.DOTALL)
+_OCTAVE_RE = re.compile(r'(\d*)(.*)', re.DOTALL)
+
+# One note token plus the separator that ends it (',' next note, '|' next
+# track, ';' next block, '' end of input)
+_TOKEN_RE = re.compile(r'([^,|;]*)([,|;]|\Z)')
+
 DEFAULT_VIBRATO_FREQ_HZ = 7.0
 DEFAULT_VIBRATO_VAR_HZ = 20.0
 DEFAULT_OCTAVE = 4
@@ -67,7 +91,7 @@ def _invalid_octave(note):
     raise PTTTLValueError("invalid octave in note '%s'" % note)
 
 def _invalid_vibrato(vdata):
-    raise PTTTLValueError("invalid vibrato settings: '%s'" % note)
+    raise PTTTLValueError("invalid vibrato settings: '%s'" % vdata)
 
 
 def _int_setting(key, val):
@@ -95,6 +119,18 @@ def _float_setting(key, val):
 def _ignore_line(line):
     return (line == "") or line.startswith('!') or line.startswith('#')
 
+def clean_source(ptttl_string):
+    """
+    Source text exactly as the parser reads it: every line stripped of outer
+    whitespace, comment ('#', '!') and blank lines dropped, and the rest
+    joined with no separator.
+
+    :param str ptttl_string: PTTTL/RTTTL source text.
+    :rtype: str
+    """
+    lines = [x.strip() for x in ptttl_string.split('\n')]
+    return ''.join([x for x in lines if not _ignore_line(x)])
+
 
 class PTTTLNote(object):
     """
@@ -105,6 +141,8 @@ class PTTTLNote(object):
     :ivar float vfreq: Vibrato frequency in Hz
     :ivar float vvar: Vibrato variance from main pitch in Hz
     """
+    __slots__ = ('pitch', 'duration', 'vibrato_frequency', 'vibrato_variance')
+
     def __init__(self, pitch, duration, vfreq=None, vvar=None):
         self.pitch = pitch
         self.duration = duration
@@ -139,12 +177,92 @@ class PTTTLNote(object):
         return self.__str__()
 
 
+class PTTTLTrack(object):
+    """
+    Represents a single track as parallel NumPy arrays, one element per note.
+    Notes without vibrato have 0.0 vibrato frequency and variance.
+
+    :ivar numpy.ndarray pitch: Note pitches in Hz (rests are <= 0)
+    :ivar numpy.ndarray duration: Note durations in seconds
+    :ivar numpy.ndarray start: Note start times in seconds from the start of the track
+    :ivar numpy.ndarray vibrato_frequency: Vibrato frequencies in Hz
+    :ivar numpy.ndarray vibrato_variance: Vibrato variances from main pitch in Hz
+    """
+    __slots__ = ('pitch', 'duration', 'start', 'vibrato_frequency', 'vibrato_variance')
+
+    def __init__(self, pitch, duration, vibrato_frequency=None, vibrato_variance=None):
+        self.pitch = np.asarray(pitch, dtype=np.float64)
+        self.duration = np.asarray(duration, dtype=np.float64)
+        if self.pitch.shape != self.duration.shape:
+            raise ValueError("pitch and duration arrays must have the same length")
+
+        self.vibrato_frequency = self._vibrato_array(vibrato_frequency)
+        self.vibrato_variance = self._vibrato_array(vibrato_variance)
+
+        self.start = np.zeros(len(self.duration))
+        if len(self.duration) > 1:
+            np.cumsum(self.duration[:-1], out=self.start[1:])
+
+    def _vibrato_array(self, values):
+        if values is None:
+            return np.zeros(len(self.pitch))
+
+        ret = np.array([0.0 if v is None else v for v in values], dtype=np.float64)
+        if ret.shape != self.pitch.shape:
+            raise ValueError("vibrato arrays must have the same length as pitch")
+
+        return ret
+
+    @classmethod
+    def from_notes(cls, notes):
+        """
+        Build a track from a list of PTTTLNote objects
+
+        :param [PTTTLNote] notes: notes in playing order
+        :rtype: PTTTLTrack
+        """
+        return cls([n.pitch for n in notes], [n.duration for n in notes],
+                   [n.vibrato_frequency for n in notes],
+                   [n.vibrato_variance for n in notes])
+
+    def has_vibrato(self):
+        """
+        Per-note equivalent of PTTTLNote.has_vibrato
+
+        :rtype: numpy.ndarray (bool)
+        """
+        return (self.vibrato_frequency > 0.0) & (self.vibrato_variance > 0.0)
+
+    def note(self, i):
+        """
+        Return a single note of this track as a PTTTLNote object
+
+        :param int i: note index
+        :rtype: PTTTLNote
+        """
+        vfreq = float(self.vibrato_frequency[i]) or None
+        vvar = float(self.vibrato_variance[i]) or None
+        return PTTTLNote(float(self.pitch[i]), float(self.duration[i]), vfreq, vvar)
+
+    def notes(self):
+        """
+        Return this track as a list of PTTTLNote objects
+
+        :rtype: [PTTTLNote]
+        """
+        return [self.note(i) for i in range(len(self))]
+
+    def __len__(self):
+        return len(self.pitch)
+
+
 class PTTTLData(object):
     """
     Represents song data extracted from a PTTTL/RTTTL file.
-    May contain multiple tracks, where each track is a list of PTTTLNote objects.
+    May contain multiple tracks, each stored as a PTTTLTrack of NumPy arrays.
 
-    :ivar [[PTTTLNote]] tracks: List of tracks. Each track is a list of PTTTLNote objects.
+    :ivar [PTTTLTrack] track_arrays: List of tracks in array form.
+    :ivar str name: Song name from the source text, if any
     :ivar float bpm: playback speed in BPM (beats per minute).
     :ivar int default_octave: Default octave to use when none is specified
     :ivar int default_duration: Default note duration to use when none is specified
@@ -153,32 +271,71 @@ class PTTTLData(object):
     """
     def __init__(self, bpm=DEFAULT_BPM, default_octave=DEFAULT_OCTAVE,
                  default_duration=DEFAULT_DURATION, default_vibrato_freq=DEFAULT_VIBRATO_FREQ_HZ,
-                 default_vibrato_var=DEFAULT_VIBRATO_VAR_HZ):
+                 default_vibrato_var=DEFAULT_VIBRATO_VAR_HZ, name=None):
+        self.name = name
         self.bpm = bpm
         self.default_octave = default_octave
         self.default_duration = default_duration
         self.default_vibrato_freq = default_vibrato_freq
         self.default_vibrato_var = default_vibrato_var
-        self.tracks = []
+        self.track_arrays = []
+
+    @classmethod
+    def from_arrays(cls, tracks, **kwargs):
+        """
+        Build song data directly from arrays, without any PTTTLNote objects
+
+        :param tracks: PTTTLTrack objects, or (pitch, duration[, vibrato_frequency,\
+            vibrato_variance]) tuples of sequences, one per track
+        :param kwargs: keyword arguments for the PTTTLData constructor
+        :rtype: PTTTLData
+        """
+        ret = cls(**kwargs)
+        for track in tracks:
+            if not isinstance(track, PTTTLTrack):
+                track = PTTTLTrack(*track)
+            ret.track_arrays.append(track)
+
+        return ret
+
+    @property
+    def tracks(self):
+        """
+        Read-only view of the tracks: a tuple per track of PTTTLNote objects.
+        Built from the arrays on every access, so it is immutable (changes
+        would be lost); use add_track() or track_arrays to change the song,
+        and prefer track_arrays for large scores.
+
+        :rtype: ((PTTTLNote))
+        """
+        return tuple(tuple(t.notes()) for t in self.track_arrays)
 
     def add_track(self, notes):
-        self.tracks.append(notes)
+        """
+        Append a track to the song
+
+        :param notes: PTTTLTrack, or sequence of PTTTLNote objects
+        """
+        if not isinstance(notes, PTTTLTrack):
+            notes = PTTTLTrack.from_notes(notes)
+        self.track_arrays.append(notes)
 
     def __str__(self):
         max_display_items = 2
 
-        if len(self.tracks) == 0:
+        if len(self.track_arrays) == 0:
             contents = "[]"
         else:
-            items = self.tracks[0][:max_display_items]
+            first = self.track_arrays[0]
+            items = [first.note(i) for i in range(min(len(first), max_display_items))]
             contents = ', '.join([str(x) for x in items])
 
-            if len(self.tracks[0]) > max_display_items:
+            if len(first) > max_display_items:
                 contents += ", ..."
 
         ret = "%s([%s]" % (self.__class__.__name__, contents)
 
-        if len(self.tracks) > 1:
+        if len(self.track_arrays) > 1:
             ret += ", ..."
 
         return ret + ')'
@@ -252,17 +409,9 @@ class PTTTLParser(object):
 
         return bpm, default, octave, vfreq, vvar
 
-    def _note_time_to_secs(self, note_time, bpm):
-        # Time in seconds for a whole note (4 beats) given current BPM.
-        whole = (60.0 / float(bpm)) * 4.0
-
-        return whole / float(note_time)
-
-    def _parse_note(self, string, bpm, default, octave, vfreq, vvar):
-        i = 0
+    def _parse_note(self, string, whole, default, octave, vfreq, vvar):
+        # Returns (pitch, duration, vibrato_freq, vibrato_var) for one note
         orig = string
-        sawdot = False
-        dur = default
         vibrato_freq = None
         vibrato_var = None
         vdata = None
@@ -275,42 +424,23 @@ class PTTTLParser(object):
         if len(string) == 0:
             raise PTTTLSyntaxError("Missing notes after comma")
 
-        # Get the note duration; if there is one, it should be the first thing
-        while i < len(string) and string[i].isdigit():
-            if i > 1:
-                _invalid_note_duration(orig)
-
-            i += 1
+        durstr, note, dot, rest = _NOTE_RE.match(string).groups()
 
-        if i > 0:
-            try:
-                dur = int(string[:i])
-            except ValueError:
+        # The note duration, if there is one, should be the first thing
+        if durstr:
+            if len(durstr) > 2 or int(durstr) == 0:
                 _invalid_note_duration(orig)
+            duration = whole / float(int(durstr))
         else:
             if not string[0].isalpha():
                 _invalid_note(orig)
+            duration = whole / float(default)
 
-        # Calculate note duration in real seconds
-        duration = self._note_time_to_secs(dur, bpm)
-
-        # Now, look for the musical note value, which should be next
-        string = string[i:]
-
-        i = 0
-        while i < len(string) and (string[i].isalpha() or string[i] == '#'):
-            i += 1
-
-        note = string[:i].strip().lower()
+        note = note.lower()
         if note == "":
             _invalid_note(orig)
 
-        if i < len(string) and string[i] == '.':
-            i += 1
-            sawdot = True
-
-        string = string[i:].strip()
-        i = 0
+        rest = rest.strip()
 
         if note == 'p':
             # This note is a rest
@@ -319,31 +449,17 @@ class PTTTLParser(object):
             if note not in NOTES:
                 _invalid_note(orig)
 
-            raw_pitch = NOTES[note]
-
-            while i < len(string) and string[i].isdigit():
-                i += 1
-
-            if string[:i] != '':
-                try:
-                    octave = int(string[:i])
-                except ValueError:
+            octstr, rest = _OCTAVE_RE.match(rest).groups()
+            if octstr != '':
+                pitch = PITCHES.get((note, int(octstr)))
+                if pitch is None:
                     _invalid_octave(note)
-
-                if not self._is_valid_octave(octave):
-                    _invalid_octave(note)
-
-            if octave < 4:
-                pitch = raw_pitch / math.pow(2, (4 - octave))
-            elif octave > 4:
-                pitch = raw_pitch * math.pow(2, (octave - 4))
             else:
-                pitch = raw_pitch
+                pitch = PITCHES[(note, octave)]
 
-            string = string[i:].strip()
-            i = 0
+            rest = rest.strip()
 
-        if sawdot or ((i < len(string)) and string[-1] == '.'):
+        if dot or rest.endswith('.'):
             duration += (duration / 2.0)
 
         if vdata is not None:
@@ -356,78 +472,162 @@ class PTTTLParser(object):
                     try:
                         vibrato_freq = float(fields[0])
                         vibrato_var = float(fields[1])
-                    except:
+                    except ValueError:
                         _invalid_vibrato(vdata)
 
                 elif len(fields) == 1:
                     try:
                         vibrato_freq = float(vdata)
-                    except:
+                    except ValueError:
                         _invalid_vibrato(vdata)
 
                     vibrato_var = vvar
 
-        return PTTTLNote(pitch, duration, vibrato_freq, vibrato_var)
+        return pitch, duration, vibrato_freq, vibrato_var
 
-    def _parse_notes(self, track_list, bpm, default, octave, vfreq, vvar):
-        ret = PTTTLData(bpm, octave, default, vfreq, vvar)
+    def _block_track_notes(self, tokens):
+        # Same result as splitting "<track>.strip().strip(',')" on commas:
+        # outer whitespace and leading/trailing empty notes are dropped.
+        # Returns None if nothing is left.
+        tokens[0] = tokens[0].lstrip()
+        tokens[-1] = tokens[-1].rstrip()
 
-        for track in track_list:
-            if track.strip() == "":
-                continue
+        first = 0
+        last = len(tokens)
+        while first < last and tokens[first] == '':
+            first += 1
+        while last > first and tokens[last - 1] == '':
+            last -= 1
 
-            buf = []
-            fields = track.split(',')
-            for note in fields:
-                note = self._parse_note(note.strip(), bpm, default, octave, vfreq, vvar)
-                buf.append(note)
+        if (last - first == 0) or (last - first == 1 and tokens[first].strip() == ''):
+            return None
 
-            ret.add_track(buf)
+        return tokens[first:last]
 
-        return ret
+    def _parse_notes(self, source, name, bpm, default, octave, vfreq, vvar, keep_empty=False):
+        # Time in seconds for a whole note (4 beats) given current BPM.
+        whole = (60.0 / float(bpm)) * 4.0
 
-    def parse(self, ptttl_string):
-        """
-        Extracts song data from ptttl/rtttl source data.
+        # Single scan over the source; each distinct note string is only
+        # parsed once, and notes go straight into per-track column buffers
+        parsed = {}
+        columns = []
+        empty_in_block = []
+        numtracks = -1
+        numblocks = 0
+        block = []
+        tokens = []
+
+        for match in _TOKEN_RE.finditer(source):
+            token, sep = match.groups()
+            tokens.append(token)
+            if sep == ',':
+                continue
 
-        :param str ptttl_string: PTTTL/RTTTL source text.
-        :return: Song data extracted from source text.
-        :rtype: PTTTLData
-        """
-        lines = [x.strip() for x in ptttl_string.split('\n')]
-        cleaned = ''.join([x for x in lines if not _ignore_line(x)])
+            block.append(tokens)
+            tokens = []
+            if sep == '|':
+                continue
 
-        fields = [f.strip() for f in cleaned.split(':')]
-        if len(fields) != 3:
-            raise PTTTLSyntaxError('expecting 3 colon-seperated fields')
+            if (numtracks > 0) and (len(block) != numtracks):
+                raise PTTTLSyntaxError('All blocks must have the same number of'
+                    'tracks')
 
-        self.name = fields[0].strip()
-        bpm, default, octave, vfreq, vvar = self._parse_config_line(fields[1])
+            numtracks = len(block)
+            numblocks += 1
+            if not columns:
+                columns = [([], [], [], []) for _ in range(numtracks)]
+                empty_in_block = [False] * numtracks
+
+            for j, block_tokens in enumerate(block):
+                notes = self._block_track_notes(block_tokens)
+                if notes is None:
+                    empty_in_block[j] = True
+                    continue
+
+                pitch, duration, vibrato_freq, vibrato_var = columns[j]
+                for note in notes:
+                    note = note.strip()
+                    values = parsed.get(note)
+                    if values is None:
+                        values = self._parse_note(note, whole, default, octave, vfreq, vvar)
+                        parsed[note] = values
+
+                    pitch.append(values[0])
+                    duration.append(values[1])
+                    vibrato_freq.append(values[2])
+                    vibrato_var.append(values[3])
+
+            block = []
+            if sep == '':
+                break
+
+        ret = PTTTLData(bpm, octave, default, vfreq, vvar, name=name)
+
+        for j in range(numtracks):
+            if empty_in_block[j] and keep_empty:
+                ret.add_track(PTTTLTrack(*columns[j]))
+                continue
 
-        numtracks = -1
-        blocks = fields[2].split(';')
-        trackdata = []
+            if empty_in_block[j]:
+                # A track with no notes at all is skipped, but a gap in only
+                # some blocks leaves an empty note between commas
+                if numblocks == 1:
+                    continue
+                raise PTTTLSyntaxError("Missing notes after comma")
 
-        for block in blocks:
-            tracks = [x.strip().strip(',') for x in block.split('|')]
-            if (numtracks > 0) and (len(tracks) != numtracks):
-                raise PTTTLSyntaxError('All blocks must have the same number of'
-                    'tracks')
+            ret.add_track(PTTTLTrack(*columns[j]))
 
-            numtracks = len(tracks)
-            trackdata.append(tracks)
+        return ret
 
-        tracks = [''] * numtracks
+    def _split_source(self, ptttl_string):
+        fields = [f.strip() for f in clean_source(ptttl_string).split(':')]
+        if len(fields) != 3:
+            raise PTTTLSyntaxError('expecting 3 colon-seperated fields')
 
-        for i in range(len(trackdata)):
-            for j in range(numtracks):
-                tracks[j] += trackdata[i][j]
-                if i < (len(trackdata) - 1):
-                    tracks[j] += ","
+        name = fields[0].strip()
+        bpm, default, octave, vfreq, vvar = self._parse_config_line(fields[1])
 
         if vfreq is None:
             vfreq = DEFAULT_VIBRATO_FREQ_HZ
         if vvar is None:
             vvar = DEFAULT_VIBRATO_VAR_HZ
 
-        return self._parse_notes(tracks, bpm, default, octave, vfreq, vvar)
+        return name, (bpm, default, octave, vfreq, vvar), fields[2]
+
+    def parse(self, ptttl_string):
+        """
+        Extracts song data from ptttl/rtttl source data. The parser keeps no
+        state between calls, so one instance can be shared between threads.
+
+        :param str ptttl_string: PTTTL/RTTTL source text.
+        :return: Song data extracted from source text.
+        :rtype: PTTTLData
+        """
+        name, settings, body = self._split_source(ptttl_string)
+        return self._parse_notes(body, name, *settings)
+
+    def split_blocks(self, ptttl_string):
+        """
+        Splits ptttl/rtttl source data into its settings and ';'-separated
+        blocks, without parsing any notes.
+
+        :param str ptttl_string: PTTTL/RTTTL source text.
+        :return: song name, settings tuple for parse_block, list of block source strings
+        :rtype: tuple
+        """
+        name, settings, body = self._split_source(ptttl_string)
+        return name, settings, body.split(';')
+
+    def parse_block(self, block, settings):
+        """
+        Parses a single block returned by split_blocks. Concatenating the
+        tracks of every block gives the same notes as parse(); a track that
+        is empty in this block is returned as a zero-length PTTTLTrack.
+
+        :param str block: block source string
+        :param tuple settings: settings tuple returned by split_blocks
+        :return: one PTTTLTrack per '|'-separated track
+        :rtype: [PTTTLTrack]
+        """
+        return self._parse_notes(block, None, *settings, keep_empty=True).track_arrays
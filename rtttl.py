@@ -1,3 +1,8 @@
+import re
+from collections import namedtuple
+
+import numpy as np
+
 NOTE = [
     440.0,	# A
     493.9,	# B or H
@@ -122,3 +127,138 @@ class RTTTL:
             #print('note ', note, 'duration', duration, 'octave', octave, 'freq', freq, 'msec', msec)
 
             yield freq, msec
+
+
+# Bulk decoding. Equivalent to RTTTL(tune).notes(), but one regex match per
+# note instead of one method call per character. Each match mirrors the
+# generator step by step: skip blanks, then either duration digits followed
+# by the end marker, or a note token (duration digits, note letter, '#', '.',
+# octave 4-7, '.') plus the one character notes() always reads past it.
+_NOTE_RE = re.compile(r' *(?:\d*(\||\Z)|(\d*.#?\.?[4-7]?\.?)(?:.|\Z))',
+                      re.DOTALL | re.ASCII)
+_TOKEN_RE = re.compile(r'(\d*)(.)(#?)(\.?)([4-7]?)(\.?)', re.DOTALL | re.ASCII)
+# A blank-separated token that notes() reads as exactly one whole note
+_CLEAN_TOKEN_RE = re.compile(r'\d*[^\d |]#?\.?[4-7]?\.?', re.DOTALL | re.ASCII)
+
+DecodeResult = namedtuple('DecodeResult', ['name', 'freqs', 'durations', 'error'])
+
+
+def _decode_token(defaults, token):
+    default_duration, default_octave, msec_per_whole_note = defaults
+    digits, note, sharp, dot1, octave, dot2 = _TOKEN_RE.fullmatch(token).groups()
+
+    duration = int(digits) if digits else 0
+    if duration == 0:
+        duration = default_duration
+
+    note = note.lower()
+    if note >= 'a' and note <= 'g':
+        note_idx = ord(note) - ord('a')
+    elif note == 'h':
+        note_idx = 1
+    else:
+        note_idx = 7
+    if sharp:
+        note_idx += 8
+
+    octave = int(octave) if octave else default_octave
+    duration_multiplier = 1.5 if (dot1 or dot2) else 1.0
+
+    freq = NOTE[note_idx] * (1 << (octave - 4))
+    msec = (msec_per_whole_note / duration) * duration_multiplier
+    return freq, msec
+
+
+def _note_arrays(notes):
+    if not notes:
+        return np.zeros(0, dtype=np.float64), np.zeros(0, dtype=np.float64)
+
+    arr = np.array(notes, dtype=np.float64)
+    return arr[:, 0].copy(), arr[:, 1].copy()
+
+
+def decode(tune, _cache=None):
+    """Decode one RTTTL string into (frequencies in Hz, durations in msec)
+       NumPy arrays, exactly as RTTTL(tune).notes() would yield them.
+    """
+    tune_pieces = tune.split(':')
+    if len(tune_pieces) != 3 or not tune_pieces[2].isascii():
+        # Non-ASCII digits/letters have odd semantics in notes(); let the
+        # reference implementation handle them (and raise its errors)
+        return _note_arrays(list(RTTTL(tune).notes()))
+
+    # Per header: the parsed defaults, an index for every token seen under
+    # them (-1 if the fast path can't use it) and the decoded (freq, msec)
+    # pairs as a list and as an array
+    if _cache is None:
+        _cache = {}
+    entry = _cache.get(tune_pieces[1])
+    if entry is None:
+        header = RTTTL(':%s:' % tune_pieces[1])
+        if not (hasattr(header, 'default_duration') and hasattr(header, 'default_octave')):
+            return _note_arrays(list(RTTTL(tune).notes()))
+
+        entry = [(header.default_duration, header.default_octave,
+                  header.msec_per_whole_note), {}, [], np.zeros((0, 2))]
+        _cache[tune_pieces[1]] = entry
+    defaults, table, values = entry[:3]
+
+    tune = tune_pieces[2].replace(',', ' ')
+
+    # Fast path: well-formed tunes are just blank-separated note tokens.
+    # A token that isn't one whole note on its own, or that fails to decode,
+    # sends the whole tune down the slow path (which raises errors in order).
+    tokens = [t for t in tune.split(' ') if t]
+    new_tokens = set(tokens).difference(table)
+    for token in new_tokens:
+        idx = -1
+        if _CLEAN_TOKEN_RE.fullmatch(token):
+            try:
+                values.append(_decode_token(defaults, token))
+                idx = len(values) - 1
+            except (ValueError, ZeroDivisionError):
+                pass
+        table[token] = idx
+    if new_tokens:
+        entry[3] = np.array(values, dtype=np.float64).reshape(-1, 2)
+
+    indices = np.array([table[t] for t in tokens], dtype=np.intp)
+    if not (indices < 0).any():
+        notes = entry[3][indices]
+        return notes[:, 0].copy(), notes[:, 1].copy()
+
+    # Slow path: follow notes() token by token, including its quirks
+    notes = []
+    for end, token in _NOTE_RE.findall(tune):
+        if not token:
+            break
+        notes.append(_decode_token(defaults, token))
+
+    return _note_arrays(notes)
+
+
+def decode_many(tunes):
+    """Decode many RTTTL strings. Returns one DecodeResult per input, in order;
+       a tune that fails to decode gets empty arrays and the error message.
+    """
+    token_cache = {}
+    results = []
+    for tune in tunes:
+        name = tune.split(':', 1)[0].strip()
+        try:
+            freqs, durations = decode(tune, token_cache)
+        except Exception as e:
+            empty = np.zeros(0, dtype=np.float64)
+            results.append(DecodeResult(name, empty, empty, '%s: %s' % (type(e).__name__, e)))
+            continue
+        results.append(DecodeResult(name, freqs, durations, None))
+
+    return results
+
+
+def decode_file(path):
+    """Decode a file with one RTTTL string per line (blank lines are skipped)."""
+    with open(path, 'r') as fh:
+        tunes = [line.strip() for line in fh]
+
+    return decode_many([t for t in tunes if t])